@@ -0,0 +1,680 @@
+"""Offline benchmarks of the counting cog.
+
+Scenarios:
+    replay - replays a synthetic stream of valid, wrong, edited and deleted counting
+             messages through `Counting` against a stand-in bot whose API calls take a
+             configurable latency and share a configurable rate limit, then reports the
+             throughput, listener latency, API calls per accepted count and persistence cost
+    parse  - validates a million synthetic messages with `parse_count` and with the
+             `re.search` pattern built for every message before it, reports the time per
+             message of both and fails if they disagree on a single message
+    state  - registers tens of thousands of channels both as `ChannelState` records and
+             in the nested server -> channels -> dict layout the settings used to be kept
+             in, reports the memory of each and the time to look a message's channel up
+    shield - has the cog respond to a steady stream of wrong counts, deleting each, while
+             only some of the deletion events ever arrive; fails if the shield holds more
+             messages than were deleted within its time to live, keeps any past it, or a
+             deletion that did arrive wasn't excused
+    save   - persists the same stream of accepted counts through the cog's journal and
+             snapshots and through the old path, which rewrote the whole settings.json
+             every 10th count of a channel and from a 600 second timer, and reports the
+             time each spends writing, their longest stall and the counts a crash loses
+
+With --stress, replay has two users post every number at the same moment and delivers
+everything at once in random order; the run fails unless each channel counted every
+number exactly once, from the earlier message, in snowflake order, with nothing
+validated between a message's validation and its acceptance.
+
+Run it from the Red directory, so that `discord` and `cogs.utils` can be imported:
+
+    python path/to/counting/bench.py replay --channels 50 --messages 200 --latency 50 --rate 50
+    python path/to/counting/bench.py replay --stress --channels 20 --messages 500
+    python path/to/counting/bench.py parse --messages 1000000 --channels 1000
+    python path/to/counting/bench.py state --channels 50000 --servers 5000
+    python path/to/counting/bench.py shield --rate 2000 --duration 10 --ttl 1 --arrive 0.7
+    python path/to/counting/bench.py save --channels 500 --counts 20000 --rate 20
+"""
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+import tracemalloc
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.getcwd())
+
+import discord
+import counting
+from cogs.utils.dataIO import dataIO
+
+class Stub:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+class FakeServer(Stub):
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+class History:
+    """What `logs_from` returns - an async iterator over stored messages."""
+
+    def __init__(self, messages):
+        self.messages = iter(messages)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.messages)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class FakeHTTP:
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def delete_message(self, channel_id, message_id, guild_id=None):
+        await self.bot.request("delete_message")
+
+    async def delete_messages(self, channel_id, message_ids, guild_id=None):
+        await self.bot.request("delete_messages")
+
+class FakeBot:
+    """Stands in for the bot. Every API call takes `latency` seconds and at most `rate`
+    calls start per second, the rest wait for the next window like discord.py does after a 429."""
+
+    def __init__(self, loop, latency=0.05, rate=50):
+        self.loop = loop
+        self.latency = latency
+        self.rate = rate
+        self.user = Stub(id="1", bot=True)
+        self.http = FakeHTTP(self)
+        self.servers = {}
+        self.history = {}
+        self.calls = Counter()
+        self.inflight = 0
+        self.limited = 0
+        self.window = 0.0
+        self.window_calls = 0
+        self.snowflakes = itertools.count(10**17)
+
+    def snowflake(self):
+        return str(next(self.snowflakes))
+
+    async def request(self, name):
+        self.calls[name] += 1
+        self.inflight += 1
+        try:
+            if self.rate:
+                limited = False
+                while True:
+                    now = self.loop.time()
+                    if now - self.window >= 1:
+                        self.window = now
+                        self.window_calls = 0
+                    if self.window_calls < self.rate:
+                        self.window_calls += 1
+                        break
+                    limited = True
+                    await asyncio.sleep(self.window + 1 - now)
+                self.limited += limited
+            await asyncio.sleep(self.latency)
+        finally:
+            self.inflight -= 1
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_channel(self, channel_id):
+        for server in self.servers.values():
+            channel = server.get_channel(channel_id)
+            if channel is not None:
+                return channel
+        return None
+
+    def logs_from(self, channel, limit=100, after=None):
+        messages = [m for m in self.history.get(channel.id, []) if after is None or int(m.id) > int(after.id)]
+        return History(messages[:limit])
+
+    async def edit_channel(self, channel, **options):
+        await self.request("edit_channel")
+        channel.topic = options.get("topic")
+
+    async def send_message(self, channel, content=None, **options):
+        await self.request("send_message")
+        return Stub(id=self.snowflake(), channel=channel, server=channel.server, author=self.user, content=content)
+
+    async def delete_message(self, message):
+        await self.request("delete_message")
+
+    async def edit_channel_permissions(self, channel, target, overwrite=None):
+        await self.request("edit_channel_permissions")
+
+def make_servers(bot, servers, channels, users):
+    result = []
+    for _ in range(servers):
+        server = FakeServer(id=bot.snowflake(), name="server", channels={}, members={})
+        server.roles = [Stub(id=server.id, name="@everyone")]
+        for i in range(users):
+            user_id = str(1000 + i)
+            server.members[user_id] = Stub(id=user_id, mention="<@{}>".format(user_id), display_name="user{}".format(i))
+        for i in range(channels):
+            channel = Stub(id=bot.snowflake(), name="counting-{}".format(i), server=server, topic=None)
+            server.channels[channel.id] = channel
+        bot.servers[server.id] = server
+        result.extend(server.channels.values())
+    return result
+
+def make_stream(bot, rng, channels, messages, invalid, edited, deleted):
+    """Builds the events to replay, in delivery order: (kind, message[, edited message])."""
+    events = []
+    next_count = {channel.id: 1 for channel in channels}
+    accepted = {channel.id: [] for channel in channels}
+    for _ in range(messages * len(channels)):
+        channel = rng.choice(channels)
+        author = rng.choice(list(channel.server.members.values()))
+        roll = rng.random()
+        if roll < edited and accepted[channel.id]:
+            before = rng.choice(accepted[channel.id])
+            after = Stub(**before.__dict__)
+            after.content = before.content + "0"
+            events.append(("edit", before, after))
+            continue
+        if roll < edited + deleted and accepted[channel.id]:
+            message = accepted[channel.id].pop(rng.randrange(len(accepted[channel.id])))
+            events.append(("delete", message))
+            continue
+        if roll < edited + deleted + invalid:
+            content = str(next_count[channel.id] + rng.randint(2, 9)) + " oops"
+        else:
+            content = str(next_count[channel.id])
+            next_count[channel.id] += 1
+        message = Stub(id=bot.snowflake(), channel=channel, server=channel.server, author=author, content=content)
+        if content.isdigit():
+            accepted[channel.id].append(message)
+        events.append(("message", message))
+    return events
+
+def make_race(bot, rng, channels, numbers):
+    """Builds a stress stream where two users post every number at the same moment.
+
+    Snowflakes interleave across channels and the events are shuffled, so the cog
+    has to restore the order. Returns the events and the message IDs that must win."""
+    events = []
+    winners = defaultdict(list)
+    for number in range(1, numbers + 1):
+        for channel in channels:
+            for author in rng.sample(list(channel.server.members.values()), 2):
+                message = Stub(id=bot.snowflake(), channel=channel, server=channel.server, author=author, content=str(number))
+                events.append(("message", message))
+            winners[channel.id].append(events[-2][1].id)
+    rng.shuffle(events)
+    return events, winners
+
+class Watch:
+    """Wraps the cog's validate and accept, recording accepted messages and
+    whether anything else got validated in between the two."""
+
+    def __init__(self, cog):
+        self.validate = cog.validate
+        self.accept = cog.accept
+        self.pending = None
+        self.interleaved = 0
+        self.accepted = defaultdict(list)
+        cog.validate = self.on_validate
+        cog.accept = self.on_accept
+
+    def on_validate(self, state, message):
+        result = self.validate(state, message)
+        self.pending = message if result is None else None
+        return result
+
+    def on_accept(self, channel_id, state, message):
+        if self.pending is not message:
+            self.interleaved += 1
+        self.pending = None
+        self.accepted[channel_id].append(message.id)
+        self.accept(channel_id, state, message)
+
+def check_race(cog, watch, channels, numbers, winners):
+    failures = []
+    for channel in channels:
+        count = cog.channels[channel.id].count
+        if count != numbers:
+            failures.append("#{} ended at {} instead of {}".format(channel.name, count, numbers))
+        elif watch.accepted[channel.id] != winners[channel.id]:
+            failures.append("#{} accepted counts out of snowflake order or from the later message".format(channel.name))
+    if watch.interleaved:
+        failures.append("{} counts were accepted after another message was validated in between".format(watch.interleaved))
+    return failures
+
+def dispatch(loop, cog, event):
+    # like discord.py, every event gets a listener task of its own
+    if event[0] == "message":
+        return loop.create_task(cog.on_message(event[1]))
+    if event[0] == "edit":
+        return loop.create_task(cog.on_message_edit(event[1], event[2]))
+    return loop.create_task(cog.on_message_delete(event[1]))
+
+async def drain(bot, cog, listeners=(), messages=()):
+    """Waits until every queued message was handled, then until the listeners
+    and the API calls they caused are done too."""
+    while cog.ingest.workers or not all(listener.done() for listener in messages):
+        await asyncio.sleep(0.001)
+    handled = time.monotonic()
+    if listeners:
+        await asyncio.wait(listeners)
+    # tasks spawned by the listeners register an API call on their first step,
+    # so the cog is idle once nothing is in flight for two polls in a row
+    idle = 0
+    while idle < 2:
+        await asyncio.sleep(0.01)
+        idle = idle + 1 if not cog.ingest.workers and bot.inflight == 0 else 0
+    return handled
+
+async def run_replay(args):
+    loop = asyncio.get_event_loop()
+    bot = FakeBot(loop, args.latency / 1000, args.rate)
+    rng = random.Random(args.seed)
+    channels = make_servers(bot, args.servers, args.channels, args.users)
+    if args.stress:
+        events, winners = make_race(bot, rng, channels, args.messages)
+        args.burst = len(events)
+    else:
+        events = make_stream(bot, rng, channels, args.messages, args.invalid, args.edited, args.deleted)
+    counting.check_folders()
+    counting.check_files()
+    cog = counting.Counting(bot)
+    watch = Watch(cog)
+    cog.ingest.latency = counting.Timings(len(events))
+    for channel in channels:
+        cog.channels[channel.id] = counting.ChannelState(channel.server.id)
+    await cog.ready.wait()
+    await drain(bot, cog)
+    bot.calls.clear()
+    bot.limited = 0
+    kinds = Counter(event[0] for event in events)
+    listeners = []
+    messages = []
+    started = time.monotonic()
+    for i, event in enumerate(events, 1):
+        listeners.append(dispatch(loop, cog, event))
+        if event[0] == "message":
+            messages.append(listeners[-1])
+        if i % args.burst == 0:
+            await asyncio.sleep(0)
+    elapsed = await drain(bot, cog, listeners, messages) - started
+    idle = time.monotonic() - started
+    latency = cog.ingest.latency
+    api_calls = sum(bot.calls.values())
+    print("Replayed {} events ({} messages, {} edits, {} deletions) in {} channels in {:.2f}s, API idle after {:.2f}s".format(len(events), kinds["message"], kinds["edit"], kinds["delete"], len(channels), elapsed, idle))
+    print("Messages: {:.0f}/s, listener latency p50 {:.1f}ms p99 {:.1f}ms".format(kinds["message"] / elapsed, latency.percentile(50) * 1000, latency.percentile(99) * 1000))
+    print("API calls: {} ({:.2f} per accepted count, {} accepted), {} held back by the rate limit".format(api_calls, api_calls / max(1, cog.accepted), cog.accepted, bot.limited))
+    print("  " + ", ".join("{} {}".format(name, calls) for name, calls in bot.calls.most_common()))
+    print("Topic edits: {} requested, {} coalesced, {} skipped, {} sent".format(cog.topics.requested, cog.topics.coalesced, cog.topics.skipped, cog.topics.edited))
+    print("Timers: {} pending at the end of the run (warning deletions and penalties not yet due)".format(len(cog.timers)))
+    print("Persistence: {} journal records ({:.0f}us avg), {} snapshots ({:.1f}ms avg)".format(cog.log_timings.count, cog.log_timings.average() * 1000000, cog.save_timings.count, cog.save_timings.average() * 1000))
+    getattr(cog, "_Counting__unload")()
+    if args.stress:
+        failures = check_race(cog, watch, channels, args.messages, winners)
+        for failure in failures:
+            print("FAILED: " + failure)
+        if failures:
+            sys.exit(1)
+        print("Stress check passed: every number was counted exactly once, by the earlier message, in snowflake order")
+
+def make_messages(rng, messages, channels, invalid, number_format):
+    """Builds (expected count, content) pairs spread over `channels` channels, each
+    channel counting on from a random number. Wrong messages are near misses."""
+    counts = [rng.randint(1, 2000) for _ in range(channels)]
+    result = []
+    for _ in range(messages):
+        i = rng.randrange(channels)
+        expected = counts[i] + 1
+        if rng.random() < invalid:
+            template = rng.choice(("{} oops", "{}!", "0{}", "{}th", "count {}", "{}"))
+            content = template.format(counting.format_count(expected + rng.choice((-1, 1, 10)), number_format))
+        else:
+            content = counting.format_count(expected, number_format)
+            if rng.random() < 0.3:
+                content += " " + rng.choice(("yay", "almost there", "<:emoji:123>", "!"))
+            counts[i] = expected if expected < 3000 else 0  # stays within roman numerals
+        result.append((expected, content))
+    return result
+
+def time_validation(messages, valid):
+    started = time.perf_counter()
+    matches = [valid(expected, content) for expected, content in messages]
+    return time.perf_counter() - started, matches
+
+def run_parse(args):
+    rng = random.Random(args.seed)
+    failures = []
+    for number_format in args.formats.split(","):
+        messages = make_messages(rng, args.messages, args.channels, args.invalid, number_format)
+        elapsed, matches = time_validation(messages, lambda expected, content: counting.parse_count(content, number_format)[0] == expected)
+        line = "{:<9} parse_count {:.0f}ns per message, {:.1%} valid".format(number_format, elapsed / len(messages) * 10**9, sum(matches) / len(messages))
+        if number_format == "decimal":
+            # the pattern every message used to be checked against, built from the next count
+            old, old_matches = time_validation(messages, lambda expected, content: re.search(r"^{}(?: .*)?$".format(expected), content) is not None)
+            line += ", re.search {:.0f}ns per message ({:.1f}x)".format(old / len(messages) * 10**9, old / elapsed)
+            disagree = sum(new != old for new, old in zip(matches, old_matches))
+            if disagree:
+                failures.append("parse_count and re.search disagree on {} decimal messages".format(disagree))
+        print(line)
+    for failure in failures:
+        print("FAILED: " + failure)
+    if failures:
+        sys.exit(1)
+
+def make_records(rng, channels, servers):
+    """Builds the fields of every channel up front, so that both layouts share the same objects."""
+    snowflakes = itertools.count(10**17, 7919)
+    server_ids = [str(next(snowflakes)) for _ in range(servers)]
+    users = [str(next(snowflakes)) for _ in range(50)]
+    records = []
+    for _ in range(channels):
+        records.append((rng.choice(server_ids), str(next(snowflakes)), rng.randint(0, 10000), rng.choice((0, 0, 0, 20000)),
+                        rng.random() < 0.3, rng.choice(users), rng.choice(tuple(counting.NUMBER_FORMATS)), str(next(snowflakes))))
+    return records, users
+
+def build_states(records):
+    return {channel_id: counting.ChannelState(server_id, count, goal, strict, last, number_format, message)
+            for server_id, channel_id, count, goal, strict, last, number_format, message in records}
+
+def build_nested(records):
+    settings = {}
+    for server_id, channel_id, count, goal, strict, last, number_format, message in records:
+        channels = settings.setdefault(server_id, {"channels": {}})["channels"]
+        channels[channel_id] = {"last": last, "count": count, "goal": goal, "strict": strict, "format": number_format, "message": message}
+    return settings
+
+def measure(build, records):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    layout = build(records)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return layout, size
+
+def lookup_state(channels, server_id, channel_id, author_id):
+    # on_message, get_state and validate
+    if channel_id not in channels:
+        return None
+    state = channels.get(channel_id)
+    if state is None or state.server_id != server_id:
+        return None
+    if state.strict and state.last == author_id:
+        return None
+    if state.goal > 0 and state.count > state.goal:
+        return None
+    return state.count
+
+def lookup_nested(settings, server_id, channel_id, author_id):
+    # the reads on_message did against the settings
+    if server_id not in settings:
+        return None
+    if channel_id not in settings[server_id]["channels"]:
+        return None
+    if settings[server_id]["channels"][channel_id]["strict"] and settings[server_id]["channels"][channel_id]["last"] == author_id:
+        return None
+    current_count = settings[server_id]["channels"][channel_id]["count"]
+    current_goal = settings[server_id]["channels"][channel_id]["goal"]
+    if current_goal > 0 and current_count > current_goal:
+        return None
+    return current_count
+
+def time_lookups(lookup, layout, messages):
+    started = time.perf_counter()
+    results = [lookup(layout, server_id, channel_id, author_id) for server_id, channel_id, author_id in messages]
+    return time.perf_counter() - started, results
+
+def run_state(args):
+    rng = random.Random(args.seed)
+    records, users = make_records(rng, args.channels, args.servers)
+    states, states_size = measure(build_states, records)
+    nested, nested_size = measure(build_nested, records)
+    print("{} channels on {} servers".format(args.channels, args.servers))
+    print("ChannelState: {:.1f}MB, {:.0f} bytes per channel".format(states_size / 2**20, states_size / args.channels))
+    print("Nested dicts: {:.1f}MB, {:.0f} bytes per channel ({:.1f}x)".format(nested_size / 2**20, nested_size / args.channels, nested_size / states_size))
+    messages = []
+    for _ in range(args.lookups):
+        record = rng.choice(records)
+        if rng.random() < args.counting:
+            messages.append((record[0], record[1], rng.choice(users)))
+        else:
+            # chatter in a channel that isn't counting, mostly on a server that has some
+            server_id = record[0] if rng.random() < 0.8 else str(rng.randrange(10**17))
+            messages.append((server_id, str(rng.randrange(10**17)), rng.choice(users)))
+    states_time, states_results = time_lookups(lookup_state, states, messages)
+    nested_time, nested_results = time_lookups(lookup_nested, nested, messages)
+    print("Lookups: {} messages, {:.0%} in counting channels".format(args.lookups, args.counting))
+    print("ChannelState: {:.0f}ns per message".format(states_time / args.lookups * 10**9))
+    print("Nested dicts: {:.0f}ns per message ({:.1f}x)".format(nested_time / args.lookups * 10**9, nested_time / states_time))
+    if states_results != nested_results:
+        sys.exit("FAILED: the layouts disagree on {} lookups".format(sum(a != b for a, b in zip(states_results, nested_results))))
+
+def most_within(times, window):
+    """The most of the sorted `times` that fall within any `window` seconds."""
+    most = 0
+    start = 0
+    for end, now in enumerate(times):
+        while now - times[start] >= window:
+            start += 1
+        most = max(most, end - start + 1)
+    return most
+
+async def run_shield(args):
+    loop = asyncio.get_event_loop()
+    bot = FakeBot(loop, args.latency / 1000, 0)
+    rng = random.Random(args.seed)
+    channels = make_servers(bot, 1, args.channels, 20)
+    counting.check_folders()
+    counting.check_files()
+    cog = counting.Counting(bot)
+    for channel in channels:
+        cog.channels[channel.id] = counting.ChannelState(channel.server.id)
+    await cog.ready.wait()
+    shield = cog.shield
+    shield.ttl = args.ttl
+    deleted = []
+    events = []
+    arrived = 0
+    sizes = []
+    started = loop.time()
+    sent = 0
+    while loop.time() - started < args.duration:
+        due = int((loop.time() - started) * args.rate)
+        for _ in range(due - sent):
+            channel = rng.choice(channels)
+            author = rng.choice(list(channel.server.members.values()))
+            message = Stub(id=bot.snowflake(), channel=channel, server=channel.server, author=author, content="oops")
+            deleted.append(time.monotonic())
+            await cog.respond(message, "wrong")
+            if rng.random() < args.arrive:
+                arrived += 1
+                events.append(loop.call_later(rng.uniform(0, args.delay / 1000), loop.create_task, cog.on_message_delete(message)))
+        sent = max(sent, due)
+        sizes.append(len(shield))
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(args.delay / 1000 + 0.1)
+    await drain(bot, cog)
+    during = max(sizes)
+    await asyncio.sleep(args.ttl)
+    shield.purge()
+    bound = most_within(deleted, args.ttl)
+    punished = bot.calls["edit_channel_permissions"]
+    print("Deleted {} wrong counts in {:.1f}s, {} deletion events arrived and {} never did".format(len(deleted), args.duration, arrived, len(deleted) - arrived))
+    print("Shield: peak {} messages, {} deletions within any {:.1f}s TTL, {} left one TTL after the last".format(shield.peak, bound, args.ttl, len(shield)))
+    print("  {} deletions excused, {} expired, {} punished".format(shield.hits, shield.expired, punished))
+    print("A shield without expiry would still hold {} messages".format(len(deleted) - arrived))
+    getattr(cog, "_Counting__unload")()
+    for event in events:
+        event.cancel()
+    failures = []
+    if max(shield.peak, during) > bound:
+        failures.append("the shield held {} messages, more than the {} deleted within its TTL".format(max(shield.peak, during), bound))
+    if len(shield):
+        failures.append("{} messages outlived the TTL".format(len(shield)))
+    if shield.hits != arrived or punished:
+        failures.append("{} of {} deletions were excused, {} members punished".format(shield.hits, arrived, punished))
+    for failure in failures:
+        print("FAILED: " + failure)
+    if failures:
+        sys.exit(1)
+
+class OldSettings:
+    """The save path the cog used before the journal: the nested settings were rewritten
+    in full on every 10th count of a channel, and 600 seconds after the first other count."""
+
+    def __init__(self, channels, rate):
+        self.settings = {}
+        for channel in channels:
+            self.settings.setdefault(channel.server.id, {"channels": {}})["channels"][channel.id] = {"last": None, "count": 0, "goal": 0, "strict": False}
+        self.timer = rate * 600     # counts accepted while the timer sleeps
+        self.pending = None
+        self.unsaved = 0
+        self.lost = 0
+        self.saves = 0
+
+    def save(self):
+        dataIO.save_json('data/counting/settings_old.json', self.settings)
+        self.saves += 1
+        self.unsaved = 0
+        self.pending = None
+
+    def accept(self, message):
+        channel = self.settings[message.server.id]["channels"][message.channel.id]
+        channel["count"] += 1
+        channel["last"] = message.author.id
+        self.unsaved += 1
+        self.lost = max(self.lost, self.unsaved)
+        if channel["count"] % 10 == 0:
+            self.save()
+        elif self.pending is None:
+            self.pending = self.timer
+        if self.pending is not None:
+            self.pending -= 1
+            if self.pending <= 0:
+                self.save()
+
+def report_saves(name, timings, counts, writes, lost):
+    ordered = sorted(timings)
+    print("{:<9} {:.2f}s writing, {:.0f}us per count, p99 {:.2f}ms, longest stall {:.1f}ms, {} full writes, up to {} counts lost on a crash".format(
+        name, sum(timings), sum(timings) / counts * 1000000, ordered[len(ordered) * 99 // 100] * 1000, ordered[-1] * 1000, writes, lost))
+
+async def run_save(args):
+    loop = asyncio.get_event_loop()
+    bot = FakeBot(loop, 0, 0)
+    rng = random.Random(args.seed)
+    channels = make_servers(bot, args.servers, args.channels // args.servers, 20)
+    counting.check_folders()
+    counting.check_files()
+    cog = counting.Counting(bot)
+    for channel in channels:
+        cog.channels[channel.id] = counting.ChannelState(channel.server.id)
+    await cog.ready.wait()
+    cog.save()
+    old = OldSettings(channels, args.rate)
+    messages = []
+    for _ in range(args.counts):
+        channel = rng.choice(channels)
+        author = rng.choice(list(channel.server.members.values()))
+        messages.append(Stub(id=bot.snowflake(), channel=channel, server=channel.server, author=author, content=""))
+    journal = []
+    saved = cog.save_timings.count
+    for message in messages:
+        state = cog.channels[message.channel.id]
+        started = time.perf_counter()
+        cog.accept(message.channel.id, state, message)
+        journal.append(time.perf_counter() - started)
+    snapshots = cog.save_timings.count - saved
+    getattr(cog, "_Counting__unload")()
+    full = []
+    for message in messages:
+        started = time.perf_counter()
+        old.accept(message)
+        full.append(time.perf_counter() - started)
+    print("{} counts in {} channels on {} servers, {} per second".format(args.counts, len(channels), args.servers, args.rate))
+    # every count is flushed to the journal before it's acknowledged
+    report_saves("journal", journal, args.counts, snapshots, 0)
+    report_saves("save_json", full, args.counts, old.saves, old.lost)
+
+def in_tempdir(run):
+    def scenario(args):
+        cwd = os.getcwd()
+        data = tempfile.mkdtemp()
+        os.chdir(data)     # the cog keeps its files under data/counting relative to the working directory
+        try:
+            asyncio.get_event_loop().run_until_complete(run(args))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(data)
+    return scenario
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the counting cog.")
+    scenarios = parser.add_subparsers(dest="scenario")
+    replay = scenarios.add_parser("replay", help="synthetic counting traffic through the cog")
+    replay.add_argument("--servers", type=int, default=5)
+    replay.add_argument("--channels", type=int, default=10, help="counting channels per server")
+    replay.add_argument("--users", type=int, default=20, help="members counting on each server")
+    replay.add_argument("--messages", type=int, default=200, help="events per channel, numbers per channel with --stress")
+    replay.add_argument("--invalid", type=float, default=0.05, help="share of messages with a wrong count")
+    replay.add_argument("--edited", type=float, default=0.01, help="share of events editing an earlier count")
+    replay.add_argument("--deleted", type=float, default=0.01, help="share of events deleting an earlier count")
+    replay.add_argument("--latency", type=float, default=50, help="API latency in milliseconds")
+    replay.add_argument("--rate", type=int, default=50, help="API calls per second, 0 for no limit")
+    replay.add_argument("--burst", type=int, default=100, help="events delivered between event loop turns")
+    replay.add_argument("--seed", type=int, default=0)
+    replay.add_argument("--stress", action="store_true", help="deliver every number twice at once in random order and check that each one was counted exactly once")
+    replay.set_defaults(run=in_tempdir(run_replay))
+    parse = scenarios.add_parser("parse", help="message validation, parse_count against re.search")
+    parse.add_argument("--messages", type=int, default=1000000, help="messages per number format")
+    parse.add_argument("--channels", type=int, default=1000, help="channels the messages are spread over, each with its own next count")
+    parse.add_argument("--invalid", type=float, default=0.2, help="share of messages with a wrong count")
+    parse.add_argument("--formats", default="decimal,hex,roman,separated", help="number formats to validate")
+    parse.add_argument("--seed", type=int, default=0)
+    parse.set_defaults(run=run_parse)
+    state = scenarios.add_parser("state", help="memory and lookup time of the channel state, ChannelState against nested dicts")
+    state.add_argument("--channels", type=int, default=50000, help="registered counting channels")
+    state.add_argument("--servers", type=int, default=5000)
+    state.add_argument("--lookups", type=int, default=1000000, help="messages to look the channel of up")
+    state.add_argument("--counting", type=float, default=0.5, help="share of the messages sent to counting channels")
+    state.add_argument("--seed", type=int, default=0)
+    state.set_defaults(run=run_state)
+    shield = scenarios.add_parser("shield", help="the deletion shield under a steady stream of wrong counts")
+    shield.add_argument("--rate", type=int, default=2000, help="wrong counts deleted per second")
+    shield.add_argument("--duration", type=float, default=10, help="seconds to keep deleting for")
+    shield.add_argument("--ttl", type=float, default=1, help="seconds the shield remembers a deletion, instead of its usual 60")
+    shield.add_argument("--arrive", type=float, default=0.7, help="share of the deletions whose event arrives")
+    shield.add_argument("--delay", type=float, default=100, help="most milliseconds a deletion event arrives after the deletion")
+    shield.add_argument("--channels", type=int, default=10)
+    shield.add_argument("--latency", type=float, default=0, help="API latency in milliseconds")
+    shield.add_argument("--seed", type=int, default=0)
+    shield.set_defaults(run=in_tempdir(run_shield))
+    save = scenarios.add_parser("save", help="the journal against rewriting settings.json every 10th count")
+    save.add_argument("--channels", type=int, default=500, help="counting channels, spread over the servers")
+    save.add_argument("--servers", type=int, default=50)
+    save.add_argument("--counts", type=int, default=20000, help="accepted counts to persist")
+    save.add_argument("--rate", type=int, default=20, help="counts per second over all channels, decides how often the old 600 second timer fired")
+    save.add_argument("--seed", type=int, default=0)
+    save.set_defaults(run=in_tempdir(run_save))
+    args = parser.parse_args()
+    if args.scenario is None:
+        parser.print_help()
+        return
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,144 +1,815 @@
 import os
-import re
+import json
+import time
 import discord
+import heapq
+import base64
 import asyncio
 import contextlib
+from array import array
+from collections import OrderedDict, deque
 from discord.ext import commands
 from cogs.utils import checks
 from cogs.utils.dataIO import dataIO
 
 __author__ = "DevilXD"
 
+DIGITS = frozenset("0123456789")
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+ROMAN_NUMERALS = (
+    ("M", 1000), ("CM", 900), ("D", 500), ("CD", 400), ("C", 100), ("XC", 90),
+    ("L", 50), ("XL", 40), ("X", 10), ("IX", 9), ("V", 5), ("IV", 4), ("I", 1),
+)
+ROMAN_VALUES = {"I": 1, "V": 5, "X": 10, "L": 50, "C": 100, "D": 500, "M": 1000}
+ROMAN_MAX = 3999
+
+def parse_decimal(token):
+    if DIGITS.issuperset(token) and (token[0] != "0" or len(token) == 1):
+        return int(token)
+    return None
+
+def parse_hex(token):
+    if token[:2] in ("0x", "0X"):
+        token = token[2:]
+    if token and HEX_DIGITS.issuperset(token):
+        return int(token, 16)
+    return None
+
+def parse_separated(token):
+    groups = token.split(",")
+    if len(groups) == 1:
+        return parse_decimal(token)
+    if not 0 < len(groups[0]) <= 3 or any(len(group) != 3 for group in groups[1:]):
+        return None
+    return parse_decimal("".join(groups))
+
+def parse_roman(token):
+    token = token.upper()
+    value = 0
+    previous = 0
+    for char in reversed(token):
+        current = ROMAN_VALUES.get(char)
+        if current is None:
+            return None
+        if current < previous:
+            value -= current
+        else:
+            value += current
+            previous = current
+    if format_roman(value) != token:
+        return None     # only accept the canonical spelling, IIII or IC are not numbers
+    return value
+
+def format_roman(number):
+    if not 0 < number <= ROMAN_MAX:
+        return str(number)
+    result = []
+    for numeral, value in ROMAN_NUMERALS:
+        while number >= value:
+            result.append(numeral)
+            number -= value
+    return "".join(result)
+
+NUMBER_FORMATS = {
+    "decimal": (parse_decimal, str),
+    "hex": (parse_hex, "0x{:X}".format),
+    "roman": (parse_roman, format_roman),
+    "separated": (parse_separated, "{:,}".format),
+}
+
+def parse_count(content, number_format="decimal"):
+    """Splits a message into its leading number and the rest of the text.
+
+    The number has to be followed by a space or the end of the message,
+    otherwise None is returned in its place."""
+    end = content.find(" ")
+    if end == -1:
+        token, rest = content, ""
+    else:
+        token, rest = content[:end], content[end+1:]
+    negative = token[:1] == "-" and number_format != "roman"
+    if negative:
+        token = token[1:]
+    if not token:
+        return None, rest
+    number = NUMBER_FORMATS[number_format][0](token)
+    if number is not None and negative:
+        number = -number
+    return number, rest
+
+def format_count(number, number_format="decimal"):
+    if number < 0:
+        return "-" + format_count(-number, number_format)
+    return NUMBER_FORMATS[number_format][1](number)
+
+class TopicScheduler:
+    """Coalesces channel topic edits, keeping only the newest wanted topic per channel."""
+
+    def __init__(self, bot, interval=10):
+        self.bot = bot
+        self.interval = interval
+        self.pending = {}
+        self.tasks = {}
+        self.requested = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.edited = 0
+
+    def schedule(self, channel, topic):
+        self.requested += 1
+        if channel.id in self.pending:
+            self.coalesced += 1
+        self.pending[channel.id] = (channel, topic)
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = self.bot.loop.create_task(self.flush(channel.id))
+
+    async def flush(self, channel_id):
+        try:
+            while channel_id in self.pending:
+                channel, topic = self.pending.pop(channel_id)
+                if (channel.topic or None) == (topic or None):
+                    self.skipped += 1
+                    continue
+                try:
+                    await self.bot.edit_channel(channel, topic=topic)
+                    self.edited += 1
+                except discord.HTTPException:
+                    pass
+                await asyncio.sleep(self.interval)  # anything scheduled meanwhile gets coalesced
+        finally:
+            del self.tasks[channel_id]
+
+    def cancel(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+class Journal:
+    """Append-only log of count changes, replayed on top of the last settings.json snapshot."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.records = 0
+        self.sequence = 0
+
+    def replay(self):
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break   # torn write from a crash, nothing after it can be trusted
+        self.records = len(records)
+        if records:
+            self.sequence = max(self.sequence, records[-1].get("q", 0))
+        return records
+
+    def append(self, record):
+        self.sequence += 1
+        record["q"] = self.sequence
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.records += 1
+
+    def truncate(self):
+        self.close()
+        open(self.path, 'w').close()
+        self.records = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Timings:
+    """Rolling window of durations, used for the percentiles shown by `count metrics`."""
+
+    def __init__(self, size=2000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+class IngestQueue:
+    """Per-channel single-writer queues, handing messages over in snowflake order."""
+
+    def __init__(self, bot, handler):
+        self.bot = bot
+        self.handler = handler
+        self.queues = {}
+        self.workers = {}
+        self.latency = Timings()
+
+    def put(self, message):
+        channel_id = message.channel.id
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = asyncio.PriorityQueue()
+        queue.put_nowait((int(message.id), time.monotonic(), message))
+        if channel_id not in self.workers:
+            self.workers[channel_id] = self.bot.loop.create_task(self.worker(channel_id))
+
+    async def worker(self, channel_id):
+        queue = self.queues[channel_id]
+        try:
+            while not queue.empty():
+                _, queued, message = queue.get_nowait()
+                try:
+                    await self.handler(message)
+                except Exception as e:
+                    print("Counting: failed to process message {}: {}".format(message.id, e))
+                self.latency.add(time.monotonic() - queued)
+        finally:
+            del self.workers[channel_id]
+            if queue.empty():
+                del self.queues[channel_id]
+
+    def cancel(self):
+        for task in list(self.workers.values()):
+            task.cancel()
+
+class ExpiringSet:
+    """Set of IDs that forgets its entries after a fixed time to live."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.peak = 0
+        self.hits = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key):
+        self.purge()
+        self.entries.pop(key, None)
+        self.entries[key] = time.monotonic() + self.ttl
+        self.peak = max(self.peak, len(self.entries))
+
+    def pop(self, key):
+        """Removes the key and returns whether it was still alive."""
+        self.purge()
+        if self.entries.pop(key, None) is None:
+            return False
+        self.hits += 1
+        return True
+
+    def purge(self):
+        # the TTL is constant, so insertion order is also expiry order
+        now = time.monotonic()
+        while self.entries:
+            key, expires = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            del self.entries[key]
+            self.expired += 1
+
+class ParseCache:
+    """Bounded LRU remembering which count each accepted message carried."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, message_id, number):
+        self.entries[message_id] = number
+        self.entries.move_to_end(message_id)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, message_id, remove=False):
+        number = self.entries.pop(message_id, None) if remove else self.entries.get(message_id)
+        if number is None:
+            self.misses += 1
+            return None
+        if not remove:
+            self.entries.move_to_end(message_id)
+        self.hits += 1
+        return number
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class TimerWheel:
+    """Fires delayed jobs from a single ticking task, bucketed into one-second slots.
+
+    Jobs are plain JSON lists so the pending queue can be saved and loaded."""
+
+    def __init__(self, bot, callback, slots=64, resolution=1):
+        self.bot = bot
+        self.callback = callback
+        self.resolution = resolution
+        self.wheel = [[] for _ in range(slots)]
+        self.position = 0
+        self.size = 0
+        self.task = None
+
+    def __len__(self):
+        return self.size
+
+    def schedule(self, delay, job):
+        ticks = max(1, int(-(-delay // self.resolution)))
+        slot = (self.position + ticks) % len(self.wheel)
+        self.wheel[slot].append([(ticks - 1) // len(self.wheel), time.time() + delay, job])
+        self.size += 1
+        if self.task is None:
+            self.task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        try:
+            await self.bot.wait_until_ready()
+            while self.size > 0:
+                await asyncio.sleep(self.resolution)
+                self.position = (self.position + 1) % len(self.wheel)
+                due = []
+                waiting = []
+                for entry in self.wheel[self.position]:
+                    if entry[0] > 0:
+                        entry[0] -= 1
+                        waiting.append(entry)
+                    else:
+                        due.append(entry[2])
+                self.wheel[self.position] = waiting
+                self.size -= len(due)
+                if due:
+                    self.bot.loop.create_task(self.callback(due))
+        finally:
+            self.task = None
+
+    def dump(self):
+        return [[entry[1], entry[2]] for slot in self.wheel for entry in slot]
+
+    def load(self, entries):
+        now = time.time()
+        for due, job in entries:
+            self.schedule(max(0, due - now), job)
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+class UserStats:
+    """Per-user counting statistics, kept as array columns indexed by user."""
+    COLUMNS = ("accepted", "mistakes", "streak", "best")
+
+    def __init__(self):
+        self.index = {}
+        self.users = array('Q')
+        for column in self.COLUMNS:
+            setattr(self, column, array('I'))
+
+    def __len__(self):
+        return len(self.users)
+
+    def slot(self, user_id):
+        i = self.index.get(user_id)
+        if i is None:
+            i = self.index[user_id] = len(self.users)
+            self.users.append(int(user_id))
+            for column in self.COLUMNS:
+                getattr(self, column).append(0)
+        return i
+
+    def count(self, user_id):
+        i = self.slot(user_id)
+        self.accepted[i] += 1
+        self.streak[i] += 1
+        if self.streak[i] > self.best[i]:
+            self.best[i] = self.streak[i]
+
+    def mistake(self, user_id):
+        i = self.slot(user_id)
+        self.mistakes[i] += 1
+        self.streak[i] = 0
+
+    def get(self, user_id):
+        i = self.index.get(user_id)
+        if i is None:
+            return None
+        return {column: getattr(self, column)[i] for column in self.COLUMNS}
+
+    def top(self, n, column="accepted"):
+        values = getattr(self, column)
+        best = heapq.nlargest(n, range(len(values)), key=values.__getitem__)
+        return [(str(self.users[i]), values[i]) for i in best if values[i] > 0]
+
+    def to_json(self):
+        data = {"users": base64.b64encode(self.users.tobytes()).decode('ascii')}
+        for column in self.COLUMNS:
+            data[column] = base64.b64encode(getattr(self, column).tobytes()).decode('ascii')
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls()
+        stats.users.frombytes(base64.b64decode(data["users"]))
+        for column in cls.COLUMNS:
+            getattr(stats, column).frombytes(base64.b64decode(data[column]))
+        stats.index = {str(user_id): i for i, user_id in enumerate(stats.users)}
+        return stats
+
+class ChannelState:
+    """In-memory state of a single counting channel."""
+    __slots__ = ("server_id", "count", "goal", "strict", "last", "number_format", "message")
+
+    def __init__(self, server_id, count=0, goal=0, strict=False, last=None, number_format="decimal", message=None):
+        self.server_id = server_id
+        self.count = count
+        self.goal = goal
+        self.strict = strict
+        self.last = last
+        self.number_format = number_format
+        self.message = message  # ID of the last accepted message, where catching up resumes from
+
+    @classmethod
+    def from_json(cls, server_id, data):
+        return cls(server_id, data["count"], data["goal"], data["strict"], data["last"], data.get("format", "decimal"), data.get("message"))
+
+    def to_json(self):
+        return {"last": self.last, "count": self.count, "goal": self.goal, "strict": self.strict, "format": self.number_format, "message": self.message}
+
+    def target(self):
+        """The count that completes the channel, 0 for none. Roman numerals run out at ROMAN_MAX."""
+        if self.number_format == "roman" and self.goal == 0:
+            return ROMAN_MAX
+        return self.goal
+
 class Counting:
     """Because who doesn't like to kill time?"""
 
     def __init__(self, bot):
         self.bot = bot
-        self.set = dataIO.load_json('data/counting/settings.json')
-        self.shield = []
+        self.channels = {}
+        self.channel_stats = {}
+        self.server_stats = {}
+        self.stats_sequence = 0
+        self.started = time.monotonic()
+        self.accepted = 0
+        self.api_calls = 0
+        self.save_timings = Timings(100)
+        self.log_timings = Timings()
+        self.shield = ExpiringSet(60)
+        self.parses = ParseCache()
         self.schedule_save = False
         self.saving_task = None
-        self.bot.loop.create_task(self.update_topics())
+        self.topics = TopicScheduler(bot)
+        self.ingest = IngestQueue(bot, self.process_message)
+        self.timers = TimerWheel(bot, self.run_timers)
+        self.timers.load(dataIO.load_json('data/counting/timers.json'))
+        self.load()
+        self.journal = Journal('data/counting/journal.log')
+        self.replay_journal()
+        self.ready = asyncio.Event()
+        self.ready_time = None
+        self.replayed = 0
+        self.bot.loop.create_task(self.reconcile())
 
-    async def update_topics(self):
+    async def reconcile(self):
         await self.bot.wait_until_ready()
-        for server_id in self.set:
-            for channel_id in self.set[server_id]["channels"]:
-                channel = self.bot.get_server(server_id).get_channel(channel_id)
-                count = self.set[server_id]["channels"][channel_id]["count"]
-                goal = self.set[server_id]["channels"][channel_id]["goal"]
-                if goal > 0:
-                    await self.bot.edit_channel(channel,topic = "Next message must start with {} | Reach {} to complete.".format(count+1,goal))
-                else:
-                    await self.bot.edit_channel(channel,topic = "Next message must start with {}".format(count+1))
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(5)
+        try:
+            await asyncio.gather(*[self.catch_up(channel_id, semaphore) for channel_id in list(self.channels)])
+        finally:
+            # counting waits on this, so it can't depend on every channel catching up cleanly
+            self.ready_time = time.monotonic() - started
+            self.ready.set()
+        print("Counting: caught up on {} messages in {} channels in {:.2f}s".format(self.replayed, len(self.channels), self.ready_time))
+
+    async def catch_up(self, channel_id, semaphore):
+        channel = self.bot.get_channel(channel_id)
+        state = self.channels.get(channel_id)
+        if channel is None or state is None:
+            return
+        async with semaphore:
+            try:
+                await self.replay_history(channel, state)
+            except Exception as e:
+                print("Counting: failed to catch up in channel {}: {}".format(channel_id, e))
+
+    async def replay_history(self, channel, state):
+        count = state.count
+        target = state.target()
+        after = state.message
+        while after is not None and not (target > 0 and state.count >= target):
+            # a request returns at most 100 messages, so page on from the newest one seen
+            page = []
+            try:
+                async for message in self.bot.logs_from(channel, limit=100, after=discord.Object(id=after)):
+                    page.append(message)
+            except discord.HTTPException:
+                after = None    # replay what arrived, but stop asking
+            page.sort(key=lambda m: int(m.id))
+            for message in page:
+                if message.author.id == self.bot.user.id or int(message.id) <= int(state.message):
+                    continue
+                if target > 0 and state.count >= target:
+                    break
+                if self.validate(state, message) is None:
+                    self.accept(channel.id, state, message)
+                    self.replayed += 1
+            if len(page) < 100:
+                break   # ran out of history
+            if after is not None:
+                after = page[-1].id
+        if target > 0 and count < target == state.count:
+            await self.reach_goal(channel, state)  # only if a replayed message completed it
+        else:
+            self.set_topic(channel, state)
+
+    def set_topic(self, channel, state):
+        target = state.target()
+        if target > 0 and state.count >= target:
+            self.topics.schedule(channel, "This channel has reached its goal of {}!".format(format_count(target, state.number_format)))
+        elif target > 0:
+            self.topics.schedule(channel, "Next message must start with {} | Reach {} to complete.".format(format_count(state.count+1, state.number_format),format_count(target, state.number_format)))
+        else:
+            self.topics.schedule(channel, "Next message must start with {}".format(format_count(state.count+1, state.number_format)))
 
     def __unload(self):
+        self.ingest.cancel()
+        self.topics.cancel()
+        self.timers.cancel()
         if self.saving_task is not None:
             self.saving_task.cancel()
         self.save()
+        self.journal.close()
+
+    def load(self):
+        settings = dataIO.load_json('data/counting/settings.json')
+        for server_id in settings:
+            for channel_id, data in settings[server_id]["channels"].items():
+                self.channels[channel_id] = ChannelState.from_json(server_id, data)
+        stats = dataIO.load_json('data/counting/stats.json')
+        self.stats_sequence = stats.get("sequence", 0)
+        for channel_id, data in stats.get("channels", {}).items():
+            self.channel_stats[channel_id] = UserStats.from_json(data)
+        for server_id, data in stats.get("servers", {}).items():
+            self.server_stats[server_id] = UserStats.from_json(data)
+
+    def snapshot(self):
+        settings = {}
+        for channel_id, state in self.channels.items():
+            if state.server_id not in settings:
+                settings[state.server_id] = {"channels": {}}
+            settings[state.server_id]["channels"][channel_id] = state.to_json()
+        return settings
 
     def save(self):
-        dataIO.save_json('data/counting/settings.json', self.set)
+        # count records only carry absolute values and stats remember the last
+        # journal sequence they include, so crashing before the truncation
+        # merely replays an already applied journal onto the new snapshot
+        started = time.monotonic()
+        dataIO.save_json('data/counting/settings.json', self.snapshot())
+        self.stats_sequence = self.journal.sequence
+        dataIO.save_json('data/counting/stats.json', {
+            "sequence": self.stats_sequence,
+            "channels": {channel_id: stats.to_json() for channel_id, stats in self.channel_stats.items()},
+            "servers": {server_id: stats.to_json() for server_id, stats in self.server_stats.items()},
+        })
+        self.journal.truncate()
+        dataIO.save_json('data/counting/timers.json', self.timers.dump())
+        self.save_timings.add(time.monotonic() - started)
+
+    def replay_journal(self):
+        self.journal.sequence = self.stats_sequence
+        for record in self.journal.replay():
+            state = self.channels.get(record["c"])
+            if state is None:
+                continue    # channel was removed after the record was written
+            if "x" in record:
+                if record["q"] > self.stats_sequence:
+                    self.update_stats(record["c"], state, record["x"], False)
+                continue
+            state.count = record["n"]
+            state.last = record["l"]
+            state.message = record.get("m")
+            if record.get("q", 0) > self.stats_sequence:
+                self.update_stats(record["c"], state, record["l"], True)
+        self.save()
 
-    def server_init(self,server):
-        self.set[server.id] = {
-            "channels": {},
-        }
+    def update_stats(self, channel_id, state, user_id, accepted):
+        for stats_map, key in ((self.channel_stats, channel_id), (self.server_stats, state.server_id)):
+            stats = stats_map.get(key)
+            if stats is None:
+                stats = stats_map[key] = UserStats()
+            if accepted:
+                stats.count(user_id)
+            else:
+                stats.mistake(user_id)
+
+    def log_mistake(self, channel_id, state, user_id):
+        self.update_stats(channel_id, state, user_id, False)
+        self.log({"c": channel_id, "x": user_id})
+
+    def log(self, record):
+        started = time.monotonic()
+        self.journal.append(record)
+        self.log_timings.add(time.monotonic() - started)
+        if self.journal.records >= 1000:
+            self.save()
+        else:
+            if self.schedule_save == False:
+                self.schedule_save = True
+            if self.saving_task is None:
+                self.saving_task = self.bot.loop.create_task(self.wait_save())
+
+    def get_state(self, channel):
+        state = self.channels.get(channel.id)
+        if state is None or channel.server is None or state.server_id != channel.server.id:
+            return None
+        return state
 
     @commands.group(pass_context=True, no_pm=True)
-    @checks.admin_or_permissions(administrator=True)
     async def count(self, ctx):
         """Because who doesn't like to kill time?"""
         if ctx.invoked_subcommand is None:
             await self.bot.send_cmd_help(ctx)
 
     @count.command(pass_context=True)
+    @checks.admin_or_permissions(administrator=True)
     async def add(self, ctx, channel : discord.Channel):
         """Makes the channel a counting channel."""
         
         server = ctx.message.server
-        if server.id not in self.set:
-            self.server_init(server)
-            await self.bot.say("Server initialized!")
-        if channel.id in self.set[server.id]["channels"]:
+        if channel.id in self.channels:
             await self.bot.say(":x: This channel is already a counting channel!")
             return
-        self.set[server.id]["channels"][channel.id] = {"last": None, "count": 0, "goal": 0, "strict": False}
+        state = self.channels[channel.id] = ChannelState(server.id)
         self.save()
-        await self.bot.edit_channel(channel,topic = "Next message must start with 1")
+        self.set_topic(channel, state)
         await self.bot.say("Channel added!")
 
     @count.command(pass_context=True)
+    @checks.admin_or_permissions(administrator=True)
     async def remove(self, ctx, channel : discord.Channel):
         """Free's up the channel."""
         
-        server = ctx.message.server
-        if server.id not in self.set:
-            await self.bot.say(":x: Uninitialized server!")
-            return
-        if channel.id not in self.set[server.id]["channels"]:
+        if self.get_state(channel) is None:
             await self.bot.say(":x: This is not a counting channel!")
             return
-        del self.set[server.id]["channels"][channel.id]
+        del self.channels[channel.id]
         self.save()
-        await self.bot.edit_channel(channel,topic = None)
+        self.topics.schedule(channel, None)
         await self.bot.say("Channel removed!")
 
     @count.command(pass_context=True, name="set")
+    @checks.admin_or_permissions(administrator=True)
     async def _set(self, ctx, channel : discord.Channel, count : int):
         """Sets the current count in a channel."""
         
-        server = ctx.message.server
-        if server.id not in self.set:
-            await self.bot.say(":x: Uninitialized server!")
-            return
-        if channel.id not in self.set[server.id]["channels"]:
+        state = self.get_state(channel)
+        if state is None:
             await self.bot.say(":x: This is not a counting channel!")
             return
-        self.set[server.id]["channels"][channel.id]["count"] = count
-        self.set[server.id]["channels"][channel.id]["last"] = None
+        if state.number_format == "roman" and not 0 <= count < ROMAN_MAX:
+            await self.bot.say(":x: Roman numerals can only count from 1 to {}!".format(ROMAN_MAX))
+            return
+        state.count = count
+        state.last = None
         self.save()
-        goal = self.set[server.id]["channels"][channel.id]["goal"]
-        if goal > 0:
-            await self.bot.edit_channel(channel,topic = "Next message must start with {} | Reach {} to complete.".format(count+1,goal))
-        else:
-            await self.bot.edit_channel(channel,topic = "Next message must start with {}".format(count+1))
+        self.set_topic(channel, state)
         await self.bot.say("Channel count set to {}!".format(count))
 
     @count.command(pass_context=True)
+    @checks.admin_or_permissions(administrator=True)
     async def strict(self, ctx, channel : discord.Channel):
         """Toggles the 'strict mode' for a counting channel."""
         
-        server = ctx.message.server
-        if server.id not in self.set:
-            await self.bot.say(":x: Uninitialized server!")
-            return
-        if channel.id not in self.set[server.id]["channels"]:
+        state = self.get_state(channel)
+        if state is None:
             await self.bot.say(":x: This is not a counting channel!")
             return
-        self.set[server.id]["channels"][channel.id]["strict"] = not self.set[server.id]["channels"][channel.id]["strict"]
+        state.strict = not state.strict
         self.save()
-        await self.bot.say("Strict mode set to {} for this server!".format(self.set[server.id]["channels"][channel.id]["strict"]))
+        await self.bot.say("Strict mode set to {} for this server!".format(state.strict))
 
     @count.command(pass_context=True)
+    @checks.admin_or_permissions(administrator=True)
     async def goal(self, ctx, channel : discord.Channel, goal : int):
         """Adds a goal to a channel. Set to 0 to remove."""
         
-        server = ctx.message.server
-        if server.id not in self.set:
-            await self.bot.say(":x: Uninitialized server!")
+        state = self.get_state(channel)
+        if state is None:
+            await self.bot.say(":x: This is not a counting channel!")
             return
-        if channel.id not in self.set[server.id]["channels"]:
+        if state.number_format == "roman" and not 0 <= goal <= ROMAN_MAX:
+            await self.bot.say(":x: Roman numerals can only count from 1 to {}!".format(ROMAN_MAX))
+            return
+        state.goal = goal
+        self.save()
+        self.set_topic(channel, state)
+        await self.bot.say("Channel goal set to {}!".format(goal))
+
+    @count.command(pass_context=True, name="format")
+    @checks.admin_or_permissions(administrator=True)
+    async def _format(self, ctx, channel : discord.Channel, number_format : str):
+        """Sets the number format of a counting channel.
+
+        Formats: decimal, hex, roman (up to 3999), separated (1,000)"""
+        
+        number_format = number_format.lower()
+        if number_format not in NUMBER_FORMATS:
+            await self.bot.say(":x: Invalid format! Valid formats are: {}".format(", ".join(sorted(NUMBER_FORMATS))))
+            return
+        state = self.get_state(channel)
+        if state is None:
             await self.bot.say(":x: This is not a counting channel!")
             return
-        self.set[server.id]["channels"][channel.id]["goal"] = goal
+        if number_format == "roman" and not (0 <= state.count < ROMAN_MAX and state.goal <= ROMAN_MAX):
+            await self.bot.say(":x: Roman numerals can only count from 1 to {}!".format(ROMAN_MAX))
+            return
+        state.number_format = number_format
         self.save()
-        current_count = self.set[server.id]["channels"][channel.id]["count"]
-        if goal > 0:
-            await self.bot.edit_channel(channel,topic = "Next message must start with {} | Reach {} to complete.".format(current_count+1,goal))
+        self.set_topic(channel, state)
+        await self.bot.say("Channel format set to {}!".format(number_format))
+
+    @count.command(pass_context=True)
+    @checks.admin_or_permissions(administrator=True)
+    async def metrics(self, ctx):
+        """Shows internal counters of the counting cog."""
+        topics = self.topics
+        shield = self.shield
+        shield.purge()
+        latency = self.ingest.latency
+        api_calls = self.api_calls + topics.edited
+        msg = "Messages: {} processed ({:.1f}/s), {} accepted, latency p50 {:.1f}ms p99 {:.1f}ms".format(latency.count, latency.count / (time.monotonic() - self.started), self.accepted, latency.percentile(50) * 1000, latency.percentile(99) * 1000)
+        msg += "\nAPI calls: {} ({:.2f} per accepted count)".format(api_calls, api_calls / max(1, self.accepted))
+        msg += "\nPersistence: {} journal records ({:.0f}us avg), {} snapshots ({:.1f}ms avg)".format(self.log_timings.count, self.log_timings.average() * 1000000, self.save_timings.count, self.save_timings.average() * 1000)
+        msg += "\nTopic edits: {} requested, {} coalesced, {} skipped, {} sent".format(topics.requested, topics.coalesced, topics.skipped, topics.edited)
+        msg += "\nTimers: {} pending".format(len(self.timers))
+        if self.ready_time is not None:
+            msg += "\nStartup: {} messages caught up in {:.2f}s".format(self.replayed, self.ready_time)
+        msg += "\nParse cache: {} messages, {:.1%} hit rate, {} evictions".format(len(self.parses), self.parses.hit_rate(), self.parses.evictions)
+        msg += "\nShield: {} messages (peak {}), {} deletions excused, {} expired".format(len(shield), shield.peak, shield.hits, shield.expired)
+        await self.bot.say("```\n" + msg + "\n```")
+
+    @count.command(pass_context=True)
+    async def stats(self, ctx, user : discord.Member=None):
+        """Shows counting statistics of a user."""
+        
+        server = ctx.message.server
+        channel = ctx.message.channel
+        if user is None:
+            user = ctx.message.author
+        msg = ""
+        for name, stats in (("#" + channel.name, self.channel_stats.get(channel.id)), (server.name, self.server_stats.get(server.id))):
+            data = stats.get(user.id) if stats is not None else None
+            if data is not None:
+                msg += "{}: {} counted, {} mistakes, longest streak {}\n".format(name, data["accepted"], data["mistakes"], data["best"])
+        if msg == "":
+            await self.bot.say("{} hasn't counted anything yet!".format(user.display_name))
+            return
+        await self.bot.say("Counting stats of {}:\n```\n{}```".format(user.display_name, msg))
+
+    @count.command(pass_context=True)
+    async def top(self, ctx, channel : discord.Channel=None):
+        """Shows the counting leaderboard of a channel or the whole server."""
+        
+        server = ctx.message.server
+        if channel is None and self.get_state(ctx.message.channel) is not None:
+            channel = ctx.message.channel
+        if channel is not None:
+            name = "#" + channel.name
+            stats = self.channel_stats.get(channel.id)
         else:
-            await self.bot.edit_channel(channel,topic = "Next message must start with {}".format(current_count+1))
-        await self.bot.say("Channel goal set to {}!".format(goal))
+            name = server.name
+            stats = self.server_stats.get(server.id)
+        if stats is None or len(stats) == 0:
+            await self.bot.say("Nobody has counted anything in {} yet!".format(name))
+            return
+        msg = ""
+        for place, (user_id, accepted) in enumerate(stats.top(10), 1):
+            member = server.get_member(user_id)
+            msg += "{:>2}. {} - {}\n".format(place, member.display_name if member else user_id, accepted)
+        await self.bot.say("Top counters in {}:\n```\n{}```".format(name, msg))
 
     async def wait_save(self):
         while self.schedule_save == True:
@@ -151,130 +822,168 @@ class Counting:
             self.save()
             self.saving_task = None
 
+    async def run_timers(self, jobs):
+        warnings = {}
+        for job in jobs:
+            if job[0] == "delete":
+                warnings.setdefault(job[1], []).append(job[2])
+            elif job[0] == "penalty":
+                await self.apply_penalty(job[1], job[2])
+        for channel_id, message_ids in warnings.items():
+            await self.delete_warnings(channel_id, message_ids)
+
+    async def delete_warnings(self, channel_id, message_ids):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return
+        for i in range(0, len(message_ids), 100):
+            chunk = message_ids[i:i+100]
+            self.api_calls += 1
+            try:
+                if len(chunk) == 1:
+                    await self.bot.http.delete_message(channel_id, chunk[0], channel.server.id)
+                else:
+                    await self.bot.http.delete_messages(channel_id, chunk, channel.server.id)
+            except discord.HTTPException:
+                pass
+
+    async def apply_penalty(self, channel_id, user_id):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return
+        member = channel.server.get_member(user_id)
+        if member is None:
+            return
+        overwrite = discord.PermissionOverwrite()
+        overwrite.read_messages = False
+        self.api_calls += 1
+        try:
+            await self.bot.edit_channel_permissions(channel, member, overwrite)
+        except discord.HTTPException:
+            pass
+
+    async def punish(self, channel, member):
+        self.api_calls += 2
+        msg = await self.bot.send_message(channel,"{} You are sneaky, but I saw it :eyes: Seems like you don't want to play by the rules...".format(member.mention))
+        overwrite = discord.PermissionOverwrite()
+        overwrite.send_messages = False
+        await self.bot.edit_channel_permissions(channel, member, overwrite)
+        self.timers.schedule(30, ["penalty", channel.id, member.id])
+        self.timers.schedule(30, ["delete", channel.id, msg.id])
+
     async def respond(self,message,response):
-        if message.author.id not in self.shield:
-            self.shield.append(message.author.id)
+        self.shield.add(message.id)
+        self.api_calls += 2
         await self.bot.delete_message(message)
         msg = await self.bot.send_message(message.channel,response)
-        await asyncio.sleep(5)
-        try:
-            await self.bot.delete_message(msg)
-        except:
-            pass
+        self.timers.schedule(5, ["delete", message.channel.id, msg.id])
 
     async def on_message(self, message):
         if message.author.id == self.bot.user.id:
             return
-        if message.server is None or message.server.id not in self.set:
-            return
-        server = message.server
-        if message.channel.id not in self.set[server.id]["channels"]:
+        if message.channel.id not in self.channels:
             return
+        self.ingest.put(message)
+
+    def validate(self, state, message):
+        """Returns None if the message carries the next count, otherwise the reason it doesn't."""
+        if state.strict and state.last == message.author.id:
+            return "{} You can't send two messages in a row to this channel!".format(message.author.mention)
+        number, _ = parse_count(message.content, state.number_format)
+        if number != state.count + 1:
+            return "{} Your message needs to start with {}".format(message.author.mention,format_count(state.count + 1, state.number_format))
+        return None
+
+    def accept(self, channel_id, state, message):
+        state.count += 1
+        state.last = message.author.id
+        state.message = message.id
+        self.parses.add(message.id, state.count)
+        self.update_stats(channel_id, state, message.author.id, True)
+        self.log({"c": channel_id, "n": state.count, "l": state.last, "m": state.message})
+
+    async def reach_goal(self, channel, state):
+        self.api_calls += 2
+        server = channel.server
+        overwrite = discord.PermissionOverwrite()
+        overwrite.send_messages = False
+        role = discord.utils.get(server.roles, id=server.id)
+        await self.bot.edit_channel_permissions(channel, role, overwrite)
+        await self.bot.send_message(channel,"Congratulations, this channel has reached it's goal of {} :tada::tada::tada:".format(state.target()))
+
+    async def process_message(self, message):
+        # runs on the channel's queue worker - validate and update the count
+        # before any await so the next message sees this one's result
+        await self.ready.wait()
         channel = message.channel
-        if self.set[server.id]["channels"][channel.id]["strict"] and self.set[server.id]["channels"][channel.id]["last"] == message.author.id:
-            await self.respond(message,"{} You can't send two messages in a row to this channel!".format(message.author.mention))
+        state = self.get_state(channel)
+        if state is None:
+            return  # channel was removed while the message was queued
+        if state.message is not None and int(message.id) <= int(state.message):
+            return  # already replayed while catching up
+        if state.goal > 0 and state.count > state.goal:
             return
-        content = message.content
-        
-        current_count = self.set[server.id]["channels"][channel.id]["count"]
-        current_goal = self.set[server.id]["channels"][channel.id]["goal"]
-        if current_goal > 0 and current_count > current_goal:
-            return
-        next_count = current_count + 1
-        has_next_count = re.search(r"^{}(?: .*)?$".format(next_count),content)
-        if has_next_count:
+        if state.number_format == "roman" and state.count >= ROMAN_MAX:
+            return  # out of roman numerals, nothing can carry the next count
+        response = self.validate(state, message)
+        if response is None:
             #Allow:
-            current_count = next_count
-            self.set[server.id]["channels"][channel.id]["count"] = current_count
-            self.set[server.id]["channels"][channel.id]["last"] = message.author.id
-            if current_count == current_goal:
-                overwrite = discord.PermissionOverwrite()
-                overwrite.send_messages = False
-                role = discord.utils.get(server.roles, id=server.id)
-                await self.bot.edit_channel_permissions(channel, role, overwrite)
-                await self.bot.send_message(channel,"Congratulations, this channel has reached it's goal of {} :tada::tada::tada:".format(current_goal))
+            self.accept(channel.id, state, message)
+            self.accepted += 1
+            if state.count == state.target():
+                await self.reach_goal(channel, state)
                 return
-            if current_goal > 0:
-                await self.bot.edit_channel(channel,topic = "Next message must start with {} | Reach {} to complete.".format(next_count+1,current_goal))
-            else:
-                await self.bot.edit_channel(channel,topic = "Next message must start with {}".format(next_count+1))
-            if next_count % 10 == 0:
-                self.save()
-            else:
-                if self.schedule_save == False:
-                    self.schedule_save = True
-                if self.saving_task is None:
-                    self.saving_task = self.bot.loop.create_task(self.wait_save())
+            self.set_topic(channel, state)
         else:
             #Deny:
-            await self.respond(message,"{} Your message needs to start with {}".format(message.author.mention,next_count))
+            self.log_mistake(channel.id, state, message.author.id)
+            self.bot.loop.create_task(self.respond(message,response))
+
+    def is_newer(self, message, state):
+        return state.message is not None and int(message.id) > int(state.message)
 
     async def on_message_edit(self, msg_before, msg_after):
         if msg_after.author.id == self.bot.user.id:
             return
-        if msg_after.server.id not in self.set:
-            return
-        server = msg_after.server
-        if msg_after.channel.id not in self.set[server.id]["channels"]:
+        state = self.get_state(msg_after.channel)
+        if state is None:
             return
         channel = msg_after.channel
-        before_content = msg_before.content
-        after_content = msg_after.content
-        
-        match = re.search(r"^(\d+)(?: .*)?$", before_content)
-        if match:
-            before_count = match.group(1)
-        else:
-            before_count = 0
-        match = re.search(r"^(\d+)(?: .*)?$", after_content)
-        if match:
-            after_count = match.group(1)
-        else:
-            after_count = 0
+        before_count = self.parses.get(msg_after.id)
+        if before_count is None:
+            if self.is_newer(msg_after, state):
+                return  # never accepted, so it isn't part of the count
+            before_count, _ = parse_count(msg_before.content, state.number_format)
+        after_count, _ = parse_count(msg_after.content, state.number_format)
         still_has_correct_count = before_count == after_count
         if still_has_correct_count:
             #Allow:
             pass
         else:
             #Deny:
-            if msg_after.author.id not in self.shield:
-                self.shield.append(msg_after.author.id)
+            self.shield.add(msg_after.id)
+            self.api_calls += 1
             await self.bot.delete_message(msg_after)
-            msg = await self.bot.send_message(channel,"{} You are sneaky, but I saw it :eyes: Seems like you don't want to play by the rules...".format(msg_after.author.mention))
-            overwrite = discord.PermissionOverwrite()
-            overwrite.send_messages = False
-            await self.bot.edit_channel_permissions(channel, msg_after.author, overwrite)
-            await asyncio.sleep(30)
-            overwrite = discord.PermissionOverwrite()
-            overwrite.read_messages = False
-            await self.bot.edit_channel_permissions(channel, msg_after.author, overwrite)
-            await self.bot.delete_message(msg)
+            await self.punish(channel, msg_after.author)
 
     async def on_message_delete(self, message):
         if message.author.id == self.bot.user.id:
             return
-        if message.server.id not in self.set:
-            return
-        server = message.server
-        if message.channel.id not in self.set[server.id]["channels"]:
+        state = self.get_state(message.channel)
+        if state is None:
             return
         channel = message.channel
         
         #Shield:
-        if message.author.id in self.shield:
-            self.shield.remove(message.author.id)
+        if self.shield.pop(message.id):
             return
+        if self.parses.get(message.id, remove=True) is None:
+            # not a count we remember - only older messages carrying a number can be one
+            if self.is_newer(message, state) or parse_count(message.content, state.number_format)[0] is None:
+                return
         
         #Deny:
-        msg = await self.bot.send_message(channel,"{} You are sneaky, but I saw it :eyes: Seems like you don't want to play by the rules...".format(message.author.mention))
-        overwrite = discord.PermissionOverwrite()
-        overwrite.send_messages = False
-        await self.bot.edit_channel_permissions(channel, message.author, overwrite)
-        await asyncio.sleep(30)
-        overwrite = discord.PermissionOverwrite()
-        overwrite.read_messages = False
-        await self.bot.edit_channel_permissions(channel, message.author, overwrite)
-        await self.bot.delete_message(msg)
+        await self.punish(channel, message.author)
 
 def check_folders():
     paths = ["data/counting"]
@@ -288,6 +997,14 @@ def check_files():
     if not dataIO.is_valid_json(f):
         print("Creating default settings.json...")
         dataIO.save_json(f, {})
+    f = "data/counting/stats.json"
+    if not dataIO.is_valid_json(f):
+        print("Creating default stats.json...")
+        dataIO.save_json(f, {})
+    f = "data/counting/timers.json"
+    if not dataIO.is_valid_json(f):
+        print("Creating default timers.json...")
+        dataIO.save_json(f, [])
 
 def setup(bot):
     check_folders()
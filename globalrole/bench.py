@@ -0,0 +1,429 @@
+"""Offline benchmarks of the GlobalRole cog.
+
+Jobs run through `GlobalRole` against a stand-in Discord API. Like discord.py, the stand-in
+HTTP client sends the requests of a route bucket one at a time and sleeps off 429s.
+
+Scenarios:
+    stream  - a job on a server only partly in the member cache, paging through the rest,
+              while a moderator keeps muting members; fails if a member is missed or a mute
+              gets reverted, and reports the member pages held at once and the peak memory
+    servers - many servers submitting jobs at once, some into channels the bot can't post in
+              anymore; reports each job's throughput and how evenly the budget was shared,
+              and fails if a job never finishes
+    workers - one job run at several worker counts against a tight member edit limit;
+              reports members per second and the 429s taken at each count
+
+Run it from the Red directory, so that `discord` and `cogs.utils` can be imported:
+
+    python path/to/globalrole/bench.py stream --members 2000 --cached 0.3 --mutes 20
+    python path/to/globalrole/bench.py servers --servers 10 --members 100 --jobs 2 --locked 0.2
+    python path/to/globalrole/bench.py workers --members 400 --workers 1,2,4,8 --limit 20
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from collections import Counter
+
+sys.path.insert(0, os.getcwd())
+
+import discord
+import globalrole
+from discord.http import Route
+
+class Stub:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+class FakeServer(Stub):
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_member(self, user_id):
+        return self.cache.get(user_id)
+
+    @property
+    def members(self):
+        return list(self.cache.values())
+
+class FakeAPI:
+    """The Discord side: every member's roles, request latency and fixed window rate limits,
+    per route bucket and for the whole bot. Edits of cached members reach the cog as member
+    updates, like they would through the gateway."""
+
+    def __init__(self, loop, rng, latency=0.03, limit=50, window=1.0, global_rate=50):
+        self.loop = loop
+        self.rng = rng
+        self.latency = latency
+        self.limit = limit
+        self.window = window
+        self.global_rate = global_rate
+        self.servers = {}
+        self.roles = {}         # server ID -> member ID -> role IDs
+        self.windows = {}
+        self.calls = Counter()
+        self.limited = Counter()
+        self.cog = None
+        self.largest_page = 0
+
+    def add_server(self, server_id, member_count, cached, roles=()):
+        everyone = Stub(id=server_id, name="@everyone")
+        server = FakeServer(id=server_id, name="server", member_count=member_count, cache={}, default_role=everyone)
+        server.roles = [everyone] + [Stub(id="{}{}".format(server_id, i), name=name, server=server) for i, name in enumerate(roles, 1)]
+        server.channels = {server_id: Stub(id=server_id, name="general", server=server, locked=False)}
+        self.roles[server.id] = {str(10**6 * int(server_id) + i): [] for i in range(member_count)}
+        for member_id in self.rng.sample(sorted(self.roles[server.id]), int(member_count * cached)):
+            server.cache[member_id] = self.member(server, member_id)
+        self.servers[server.id] = server
+        return server
+
+    def member(self, server, member_id):
+        role_ids = self.roles[server.id][member_id]
+        return Stub(id=member_id, server=server, roles=[role for role in server.roles if role.id in role_ids or role is server.default_role])
+
+    def set_roles(self, server, member_id, role_ids):
+        self.roles[server.id][member_id] = [role_id for role_id in role_ids if role_id != server.id]
+        before = server.cache.get(member_id)
+        if before is not None:
+            after = server.cache[member_id] = self.member(server, member_id)
+            if self.cog is not None:
+                self.loop.create_task(self.cog.on_member_update(before, after))
+
+    def limited_for(self, key, limit, window):
+        """Seconds until the window of `key` has room again, 0 if the call goes through."""
+        now = self.loop.time()
+        start, calls = self.windows.get(key, (now, 0))
+        if now - start >= window:
+            start, calls = now, 0
+        if calls >= limit:
+            return start + window - now
+        self.windows[key] = (start, calls + 1)
+        return 0
+
+    async def handle(self, route, params=None, json=None):
+        """Returns the status and the data of a request."""
+        self.calls["{} {}".format(route.method, route.path)] += 1
+        await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if self.global_rate:
+            retry_after = self.limited_for("global", self.global_rate, 1.0)
+            if retry_after:
+                self.limited["global"] += 1
+                return 429, {"retry_after": retry_after * 1000, "global": True}
+        retry_after = self.limited_for(route.bucket, self.limit, self.window)
+        if retry_after:
+            self.limited[route.method + " " + route.path] += 1
+            return 429, {"retry_after": retry_after * 1000, "global": False}
+        parts = route.url.split("/")
+        server = self.servers[route.guild_id]
+        members = self.roles[server.id]
+        if route.path == "/guilds/{guild_id}/members":
+            after = int(params.get("after", 0))
+            page = sorted((member_id for member_id in members if int(member_id) > after), key=int)[:params["limit"]]
+            self.largest_page = max(self.largest_page, len(page))
+            return 200, [{"user": {"id": member_id}, "roles": list(members[member_id])} for member_id in page]
+        if route.path.endswith("/roles/{role_id}"):
+            member_id, role_id = parts[-3], parts[-1]
+        else:
+            member_id, role_id = parts[-1], None
+        if member_id not in members:
+            return 404, "Unknown Member"
+        if route.method == "PUT":
+            self.set_roles(server, member_id, members[member_id] + [role_id] * (role_id not in members[member_id]))
+            return 204, ""
+        if route.method == "DELETE":
+            self.set_roles(server, member_id, [other for other in members[member_id] if other != role_id])
+            return 204, ""
+        if route.method == "PATCH":
+            self.set_roles(server, member_id, json["roles"])
+            return 204, ""
+        return 200, {"user": {"id": member_id}, "roles": list(members[member_id])}
+
+class FakeHTTP:
+    """What discord.py's HTTPClient does with a request: one at a time per route bucket,
+    429s slept off and retried up to 5 times, error statuses raised."""
+
+    def __init__(self, api):
+        self.api = api
+        self.locks = {}
+        self.global_over = asyncio.Event()
+        self.global_over.set()
+
+    async def request(self, route, **kwargs):
+        lock = self.locks.setdefault(route.bucket, asyncio.Lock())
+        await self.global_over.wait()
+        async with lock:
+            for tries in range(5):
+                status, data = await self.api.handle(route, **kwargs)
+                if status == 429:
+                    if data["global"]:
+                        self.global_over.clear()
+                    await asyncio.sleep(data["retry_after"] / 1000)
+                    self.global_over.set()
+                    continue
+                response = Stub(status=status, reason="", headers={})
+                if status == 403:
+                    raise discord.Forbidden(response, data)
+                if status == 404:
+                    raise discord.NotFound(response, data)
+                if status >= 300:
+                    raise discord.HTTPException(response, data)
+                return data
+
+    def replace_roles(self, user_id, guild_id, role_ids):
+        route = Route('PATCH', '/guilds/{guild_id}/members/{user_id}', guild_id=guild_id, user_id=user_id)
+        return self.request(route, json={"roles": role_ids})
+
+    def add_role(self, guild_id, user_id, role_id):
+        route = Route('PUT', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}', guild_id=guild_id, user_id=user_id, role_id=role_id)
+        return self.request(route)
+
+    def remove_role(self, guild_id, user_id, role_id):
+        route = Route('DELETE', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}', guild_id=guild_id, user_id=user_id, role_id=role_id)
+        return self.request(route)
+
+class FakeBot:
+    def __init__(self, loop, api):
+        self.loop = loop
+        self.api = api
+        self.http = FakeHTTP(api)
+        self.messages = Counter()
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_server(self, server_id):
+        return self.api.servers.get(server_id)
+
+    async def message(self, name, channel):
+        # messages have their own rate limits, they only take the latency here
+        self.messages[name] += 1
+        await asyncio.sleep(self.api.latency)
+        if channel.locked:
+            raise discord.Forbidden(Stub(status=403, reason="Forbidden", headers={}), "Missing Permissions")
+        return Stub(channel=channel)
+
+    async def send_message(self, channel, content=None, **options):
+        return await self.message("send_message", channel)
+
+    async def edit_message(self, message, new_content=None, **options):
+        return await self.message("edit_message", message.channel)
+
+    async def delete_message(self, message):
+        await self.message("delete_message", message.channel)
+
+def make_cog(bot):
+    globalrole.check_folders()
+    globalrole.check_files()
+    cog = globalrole.GlobalRole(bot)
+    bot.api.cog = cog
+    finished = {}
+    execute = cog.execute
+    async def timed(job):
+        try:
+            await execute(job)
+        finally:
+            finished[job.id] = time.monotonic()
+    cog.execute = timed
+    return cog, finished
+
+def add_job(cog, server, add, remove=()):
+    job = globalrole.RoleJob(cog.next_id, server, server.channels[server.id], "set", list(add), list(remove), None)
+    cog.next_id += 1
+    job.text = "Changing `{}` roles of all server members... ({}/{})"
+    job.done_text = "Changed `{}` roles of all server members! ({}/{})"
+    cog.submit(job)
+    return job
+
+async def wait_jobs(cog):
+    """Waits until every job finished, or the ones left can't go on anymore. Returns the ones left."""
+    while cog.jobs:
+        if all(job.task is not None and job.task.done() for job in cog.running.values()):
+            break
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.1)
+    return list(cog.jobs.values())
+
+async def run_stream(args):
+    loop = asyncio.get_event_loop()
+    rng = random.Random(args.seed)
+    api = FakeAPI(loop, rng, args.latency / 1000, args.limit, args.window, args.global_rate)
+    bot = FakeBot(loop, api)
+    server = api.add_server("1", args.members, args.cached, ("Member", "Newcomer", "Muted"))
+    member_role, newcomer, muted = server.roles[1:4]
+    # members with one role to change get it through the role's own endpoint, the ones
+    # with both through a member edit replacing their role list
+    for member_id, role_ids in api.roles[server.id].items():
+        api.set_roles(server, member_id, [member_role.id] * (rng.random() < args.have) + [newcomer.id] * (rng.random() < args.newcomers))
+    cog, finished = make_cog(bot)
+    cog.index.get(server)
+    mutes = set()
+
+    async def moderate():
+        while True:
+            await asyncio.sleep(rng.expovariate(args.mutes))
+            member_id = rng.choice(sorted(api.roles[server.id]))
+            if muted.id not in api.roles[server.id][member_id]:
+                api.set_roles(server, member_id, api.roles[server.id][member_id] + [muted.id])
+                mutes.add(member_id)
+
+    memory = []
+
+    async def sample():
+        # only what the cog allocates, the stand-in API keeps every member around
+        only_cog = [tracemalloc.Filter(True, globalrole.__file__)]
+        while True:
+            traces = tracemalloc.take_snapshot().filter_traces(only_cog)
+            memory.append(sum(stat.size for stat in traces.statistics("filename")))
+            await asyncio.sleep(0.5)
+
+    tracemalloc.start()
+    started = time.monotonic()
+    job = add_job(cog, server, [member_role], [newcomer])
+    moderator = loop.create_task(moderate())
+    sampler = loop.create_task(sample())
+    left = await wait_jobs(cog)
+    moderator.cancel()
+    sampler.cancel()
+    tracemalloc.stop()
+    elapsed = finished.get(job.id, time.monotonic()) - started
+    missed = [member_id for member_id, role_ids in api.roles[server.id].items() if member_role.id not in role_ids or newcomer.id in role_ids]
+    reverted = [member_id for member_id in mutes if muted.id not in api.roles[server.id][member_id]]
+    print("{} members, {} cached, set +Member;-Newcomer".format(args.members, len(server.cache)))
+    print("Job: {} members gone through in {:.1f}s ({:.1f}/s), {} changed, {} failed".format(job.count, elapsed, job.count / elapsed, job.changed, job.failed))
+    print("Members muted during the job: {}, reverted: {}".format(len(mutes), len(reverted)))
+    print("Largest member page: {}, the cog's memory while running: {:.0f}KB at most".format(api.largest_page, max(memory) / 1024))
+    print("API calls: " + ", ".join("{} {}".format(name, calls) for name, calls in api.calls.most_common()))
+    print("429s: " + (", ".join("{} {}".format(name, calls) for name, calls in api.limited.most_common()) or "none"))
+    getattr(cog, "_GlobalRole__unload")()
+    failures = []
+    if left:
+        failures.append("the job never finished")
+    if missed:
+        failures.append("{} members never got their roles changed".format(len(missed)))
+    if reverted:
+        failures.append("{} mutes were reverted by the job".format(len(reverted)))
+    for failure in failures:
+        print("FAILED: " + failure)
+    if failures:
+        sys.exit(1)
+
+def fairness(values):
+    """Jain's index, 1 when everyone got the same and 1/n when one got everything."""
+    return sum(values) ** 2 / (len(values) * sum(value * value for value in values)) if any(values) else 1.0
+
+async def run_servers(args):
+    loop = asyncio.get_event_loop()
+    rng = random.Random(args.seed)
+    api = FakeAPI(loop, rng, args.latency / 1000, args.limit, args.window, args.global_rate)
+    bot = FakeBot(loop, api)
+    names = ["Role {}".format(i) for i in range(1, args.jobs + 1)]
+    servers = [api.add_server(str(i), args.members, 1.0, names) for i in range(1, args.servers + 1)]
+    for server in rng.sample(servers, int(args.servers * args.locked)):
+        server.channels[server.id].locked = True
+    cog, finished = make_cog(bot)
+    started = time.monotonic()
+    jobs = [[add_job(cog, server, [role]) for role in server.roles[1:]] for server in servers]
+    first = [server_jobs[0] for server_jobs in jobs]
+    # how far each server's first job got when the first of them was done
+    while not finished and cog.jobs:
+        await asyncio.sleep(0.05)
+    progress = [job.count for job in first]
+    left = await wait_jobs(cog)
+    elapsed = time.monotonic() - started
+    rates = sorted(job.count / (finished[job.id] - started) for job in first if job.id in finished)
+    total = sum(job.count for server_jobs in jobs for job in server_jobs)
+    print("{} servers with {} jobs of {} members each, {} of them posting into a locked channel".format(args.servers, args.jobs, args.members, int(args.servers * args.locked)))
+    print("All jobs: {} members in {:.1f}s ({:.1f}/s)".format(total, elapsed, total / elapsed))
+    if rates:
+        print("First jobs: {:.1f} to {:.1f} members/s, median {:.1f}".format(rates[0], rates[-1], rates[len(rates) // 2]))
+    print("When the first job finished, the others were {} to {} members in, fairness {:.3f}".format(min(progress), max(progress), fairness(progress)))
+    print("API calls: " + ", ".join("{} {}".format(name, calls) for name, calls in api.calls.most_common()))
+    print("429s: " + (", ".join("{} {}".format(name, calls) for name, calls in api.limited.most_common()) or "none"))
+    getattr(cog, "_GlobalRole__unload")()
+    failures = []
+    if left:
+        failures.append("{} jobs never finished, their servers stayed busy".format(len(left)))
+    if fairness(progress) < args.fairness:
+        failures.append("the servers didn't share the budget evenly")
+    for failure in failures:
+        print("FAILED: " + failure)
+    if failures:
+        sys.exit(1)
+
+async def run_workers(args):
+    loop = asyncio.get_event_loop()
+    print("{} members with a member edit each (set +A;-B), {:.0%} of them cached, member edits limited to {} per {}s".format(args.members, args.cached, args.limit, args.window))
+    print("workers  members/s  route 429s  global 429s  bucket rate at the end")
+    for workers in [int(count) for count in args.workers.split(",")]:
+        rng = random.Random(args.seed)
+        api = FakeAPI(loop, rng, args.latency / 1000, args.limit, args.window, args.global_rate)
+        bot = FakeBot(loop, api)
+        server = api.add_server("1", args.members, args.cached, ("A", "B"))
+        for member_id in api.roles[server.id]:
+            api.set_roles(server, member_id, [server.roles[2].id])
+        cog, finished = make_cog(bot)
+        cog.concurrency = workers
+        job = add_job(cog, server, [server.roles[1]], [server.roles[2]])
+        left = await wait_jobs(cog)
+        rate = job.count / (finished[job.id] - job.started) if job.id in finished else 0
+        route = sum(calls for name, calls in api.limited.items() if name != "global")
+        print("{:>7}  {:>9.1f}  {:>10}  {:>11}  {:>6.1f}/s".format(workers, rate, route, api.limited["global"], cog.bucket.rate))
+        getattr(cog, "_GlobalRole__unload")()
+        if left or job.failed:
+            sys.exit("FAILED: the job with {} workers didn't change every member".format(workers))
+
+def in_tempdir(run):
+    def scenario(args):
+        cwd = os.getcwd()
+        data = tempfile.mkdtemp()
+        os.chdir(data)     # the cog keeps its files under data/globalrole relative to the working directory
+        try:
+            asyncio.get_event_loop().run_until_complete(run(args))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(data)
+    return scenario
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the GlobalRole cog.")
+    scenarios = parser.add_subparsers(dest="scenario")
+    def add_scenario(name, help, limit=50):
+        scenario = scenarios.add_parser(name, help=help)
+        scenario.add_argument("--latency", type=float, default=30, help="API latency in milliseconds")
+        scenario.add_argument("--limit", type=int, default=limit, help="requests per route bucket and window")
+        scenario.add_argument("--window", type=float, default=1.0, help="seconds of a route bucket's window")
+        scenario.add_argument("--global-rate", type=int, default=50, help="requests per second for the whole bot, 0 for no limit")
+        scenario.add_argument("--seed", type=int, default=0)
+        return scenario
+    stream = add_scenario("stream", "a job on a server partly in the member cache, with members muted meanwhile")
+    stream.add_argument("--members", type=int, default=2000)
+    stream.add_argument("--cached", type=float, default=0.3, help="share of the members in the cache")
+    stream.add_argument("--have", type=float, default=0.2, help="share of the members that already have the Member role")
+    stream.add_argument("--newcomers", type=float, default=0.5, help="share of the members with the Newcomer role")
+    stream.add_argument("--mutes", type=float, default=20, help="members muted per second while the job runs")
+    stream.set_defaults(run=in_tempdir(run_stream))
+    servers = add_scenario("servers", "many servers submitting jobs at once")
+    servers.add_argument("--servers", type=int, default=10)
+    servers.add_argument("--members", type=int, default=100, help="members per server")
+    servers.add_argument("--jobs", type=int, default=2, help="jobs each server submits, one role each")
+    servers.add_argument("--locked", type=float, default=0.2, help="share of the servers where the bot can't post anymore")
+    servers.add_argument("--fairness", type=float, default=0.9, help="least fairness index that passes")
+    servers.set_defaults(run=in_tempdir(run_servers))
+    workers = add_scenario("workers", "members per second against the worker count", limit=20)
+    workers.add_argument("--members", type=int, default=400)
+    workers.add_argument("--workers", default="1,2,4,8", help="worker counts to run the job with")
+    workers.add_argument("--cached", type=float, default=1.0, help="share of the members in the cache, the others are read before their edit")
+    workers.set_defaults(run=in_tempdir(run_workers))
+    args = parser.parse_args()
+    if args.scenario is None:
+        parser.print_help()
+        return
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
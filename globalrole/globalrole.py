@@ -1,14 +1,477 @@
+import os
+import re
+import time
+import random
 import discord
 import asyncio
+import aiohttp
 from discord.ext import commands
+from discord.http import Route
 from cogs.utils import checks
+from cogs.utils.dataIO import dataIO
+from collections import OrderedDict, deque
+
+class TokenBucket:
+    """Paces API requests, backing off on rate limits and speeding back up while calls go through."""
+
+    def __init__(self, rate=5.0, capacity=5, min_rate=0.5, max_rate=50.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self, retry_after=None):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def relax(self):
+        self.rate = min(self.max_rate, self.rate * 1.02)
+
+class FairScheduler:
+    """Hands out the shared bucket's tokens round-robin between the jobs asking for them."""
+
+    def __init__(self, loop, bucket):
+        self.loop = loop
+        self.bucket = bucket
+        self.waiters = OrderedDict()
+        self.task = None
+
+    async def acquire(self, job_id):
+        future = self.loop.create_future()
+        self.waiters.setdefault(job_id, deque()).append(future)
+        if self.task is None:
+            self.task = self.loop.create_task(self.dispatch())
+        await future
+
+    async def dispatch(self):
+        try:
+            while self.waiters:
+                job_id, futures = next(iter(self.waiters.items()))
+                future = futures.popleft()
+                if futures:
+                    self.waiters.move_to_end(job_id)
+                else:
+                    del self.waiters[job_id]
+                if future.done():
+                    continue    # the worker was cancelled while waiting
+                await self.bucket.acquire()
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            self.task = None
+
+class RoleFilter:
+    """A boolean role expression like `Member & !Muted & (EU | NA)`, compiled to a matcher on role bitsets."""
+
+    TOKEN = re.compile(r'\s*(?:"([^"]*)"|([&|!()])|([^&|!()"]+))')
+
+    def __init__(self, text, roles):
+        self.text = text.strip()
+        self.tokens = []
+        position = 0
+        while position < len(text):
+            match = self.TOKEN.match(text, position)
+            if match is None:
+                raise ValueError("That filter expression is invalid!")
+            position = match.end()
+            quoted, operator, name = match.groups()
+            if operator is not None:
+                self.tokens.append(operator)
+            elif quoted is not None or name.strip():
+                role = discord.utils.get(roles, name=quoted if quoted is not None else name.strip())
+                if role is None:
+                    raise ValueError("That role doesn't seem to exist!")
+                self.tokens.append(role)
+        self.position = 0
+        self.tree = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError("That filter expression is invalid!")
+        del self.tokens
+
+    def next(self, *operators):
+        if self.position < len(self.tokens) and self.tokens[self.position] in operators:
+            self.position += 1
+            return True
+        return False
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.next("|"):
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.next("&"):
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_not(self):
+        if self.next("!"):
+            return ("not", self.parse_not())
+        if self.next("("):
+            node = self.parse_or()
+            if not self.next(")"):
+                raise ValueError("That filter expression is invalid!")
+            return node
+        if self.position < len(self.tokens) and not isinstance(self.tokens[self.position], str):
+            self.position += 1
+            return ("role", self.tokens[self.position - 1])
+        raise ValueError("That filter expression is invalid!")
+
+    def compile(self, mask, node=None):
+        """Returns a function of a member's role bits, `mask` maps a list of roles to their bits."""
+        kind, arg = node or self.tree
+        if kind == "role":
+            bit = mask([arg])
+            return lambda bits: bits & bit != 0
+        if kind == "not":
+            if arg[0] == "role":
+                bit = mask([arg[1]])
+                return lambda bits: bits & bit == 0
+            inner = self.compile(mask, arg)
+            return lambda bits: not inner(bits)
+        # plain roles and negated roles fold into a single mask test each
+        plain = mask([node[1] for node in arg if node[0] == "role"])
+        negated = mask([node[1][1] for node in arg if node[0] == "not" and node[1][0] == "role"])
+        rest = [self.compile(mask, node) for node in arg if node[0] != "role" and (node[0] != "not" or node[1][0] != "role")]
+        if kind == "and":
+            if not rest:
+                return lambda bits: bits & plain == plain and bits & negated == 0
+            return lambda bits: bits & plain == plain and bits & negated == 0 and all(f(bits) for f in rest)
+        # !A | !B only fails for members with all of the roles
+        if not rest:
+            return lambda bits: bits & plain != 0 or bits & negated != negated
+        return lambda bits: bits & plain != 0 or bits & negated != negated or any(f(bits) for f in rest)
+
+class RoleJob:
+    """A single globalrole operation, either queued or running."""
+
+    def __init__(self, job_id, server, channel, operation, add, remove, rfilter):
+        self.id = job_id
+        self.server = server
+        self.channel = channel
+        self.operation = operation
+        self.add = add
+        self.remove = remove
+        self.filter = rfilter
+        if operation == "set":
+            names = (";".join(["+" + role.name for role in add] + ["-" + role.name for role in remove]),)
+        else:
+            names = tuple(role.name for role in add + remove)
+        self.names = names if rfilter is None else names + (rfilter.text,)
+        self.match = None
+        self.add_mask = 0
+        self.remove_mask = 0
+        self.text = None
+        self.done_text = None
+        self.total = 0
+        self.count = 0
+        self.changed = 0
+        self.failed = 0
+        self.base = 0
+        self.changed_base = 0
+        self.started = None
+        self.stop = False
+        self.task = None
+        self.cursor = None
+        self.inflight = OrderedDict()
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "server": self.server.id,
+            "channel": self.channel.id,
+            "operation": self.operation,
+            "add": [role.id for role in self.add],
+            "remove": [role.id for role in self.remove],
+            "filter": self.filter.text if self.filter is not None else None,
+            "text": self.text,
+            "done_text": self.done_text,
+            "cursor": self.cursor,
+            # members finished past the cursor get revisited on resume, don't count them twice
+            "count": self.count - sum(1 for done in self.inflight.values() if done),
+            "changed": self.changed,
+            "failed": self.failed,
+        }
+
+    @classmethod
+    def from_json(cls, bot, data):
+        server = bot.get_server(data["server"])
+        if server is None:
+            return None
+        channel = server.get_channel(data["channel"])
+        add = [discord.utils.get(server.roles, id=role_id) for role_id in data["add"]]
+        remove = [discord.utils.get(server.roles, id=role_id) for role_id in data["remove"]]
+        if channel is None or None in add or None in remove:
+            return None
+        rfilter = None
+        if data["filter"] is not None:
+            try:
+                rfilter = RoleFilter(data["filter"], server.roles)
+            except ValueError:
+                return None
+        job = cls(data["id"], server, channel, data["operation"], add, remove, rfilter)
+        job.text = data["text"]
+        job.done_text = data["done_text"]
+        job.cursor = data["cursor"]
+        job.count = data["count"]
+        job.changed = data["changed"]
+        job.failed = data["failed"]
+        return job
+
+    def complete(self, member_id):
+        # workers finish out of order, the cursor only moves past members
+        # once everything before them in the stable ID order is done too
+        self.inflight[member_id] = True
+        while self.inflight:
+            first_id, done = next(iter(self.inflight.items()))
+            if not done:
+                break
+            self.inflight.popitem(last=False)
+            self.cursor = first_id
+
+    def rate(self):
+        """Members per second since the job (re)started, None before the first one is done."""
+        done = self.count - self.base
+        elapsed = time.monotonic() - self.started
+        return done / elapsed if done > 0 and elapsed > 0 else None
+
+    def eta(self):
+        rate = self.rate()
+        if rate is None:
+            return ""
+        remaining = (self.total - self.count) / rate
+        return " - {:.1f} members/s, ETA {}m {}s".format(rate, int(remaining // 60), int(remaining % 60))
+
+    def progress(self):
+        return self.text.format(*self.names, self.count, self.total) + self.eta()
+
+    def compile(self, index):
+        mask = lambda roles: index.mask(self.server, roles)
+        self.match = self.filter.compile(mask) if self.filter is not None else None
+        self.add_mask = mask(self.add)
+        self.remove_mask = mask(self.remove)
+
+    def needs_change(self, bits):
+        if self.match is not None and not self.match(bits):
+            return False
+        return bits & self.add_mask != self.add_mask or bits & self.remove_mask != 0
+
+    def changes(self, role_ids):
+        """The IDs of the roles to add to and remove from a member with `role_ids`."""
+        return [role.id for role in self.add if role.id not in role_ids], [role.id for role in self.remove if role.id in role_ids]
+
+    def new_roles(self, role_ids):
+        remove = set(role.id for role in self.remove)
+        remove.add(self.server.default_role.id)
+        role_ids = [role_id for role_id in role_ids if role_id not in remove]
+        return role_ids + [role.id for role in self.add if role.id not in role_ids]
+
+class RoleIndex:
+    """Role bitsets of every member per server, built once and kept up to date from member events."""
+
+    def __init__(self):
+        self.servers = {}
+        self.positions = {}
+        self.next_bit = {}
+
+    def get(self, server):
+        members = self.servers.get(server.id)
+        if members is None:
+            members = self.servers[server.id] = {}
+            for member in server.members:
+                self.add(member)
+        return members
+
+    def complete(self, server):
+        return len(server.members) >= server.member_count
+
+    def mask(self, server, roles):
+        return self.mask_ids(server, (role.id for role in roles))
+
+    def mask_ids(self, server, role_ids):
+        positions = self.positions.setdefault(server.id, {})
+        bits = 0
+        for role_id in role_ids:
+            position = positions.get(role_id)
+            if position is None:
+                # bits of deleted roles are never handed out again
+                position = positions[role_id] = self.next_bit.get(server.id, 0)
+                self.next_bit[server.id] = position + 1
+            bits |= 1 << position
+        return bits
+
+    def bits(self, member):
+        return self.mask(member.server, member.roles)
+
+    def add(self, member):
+        members = self.servers.get(member.server.id)
+        if members is not None:
+            members[member.id] = self.bits(member)
+
+    def remove(self, member):
+        members = self.servers.get(member.server.id)
+        if members is not None:
+            members.pop(member.id, None)
+
+    def update(self, before, after):
+        if before.roles != after.roles:
+            self.add(after)
+
+    def remove_role(self, role):
+        members = self.servers.get(role.server.id)
+        position = self.positions.get(role.server.id, {}).pop(role.id, None)
+        if members is None or position is None:
+            return
+        keep = ~(1 << position)
+        for member_id, bits in members.items():
+            members[member_id] = bits & keep
+
+    def matching(self, server, match):
+        return [member_id for member_id, bits in self.get(server).items() if match(bits)]
+
+    def targets(self, server, job):
+        """IDs of the cached members the job changes, in ID order."""
+        job.compile(self)
+        return sorted(self.matching(server, job.needs_change), key=int)
+
+class MemberStream:
+    """Members a job goes through, in ID order and a page at a time.
+
+    With the whole server in the member cache, the pages are the planned targets. Otherwise the
+    members are paged through the API as the job goes, holding one page no matter the server size."""
+
+    def __init__(self, http, index, job, limit=1000):
+        self.http = http
+        self.job = job
+        self.limit = limit
+        self.after = job.cursor
+        self.cached = index.complete(job.server)
+        if self.cached:
+            self.targets = index.targets(job.server, job)
+            if job.cursor is not None:
+                self.targets = [member_id for member_id in self.targets if int(member_id) > int(job.cursor)]
+            self.total = job.count + len(self.targets)
+        else:
+            job.compile(index)
+            self.targets = None
+            self.total = max(job.count, job.server.member_count)
+
+    async def next_page(self):
+        """Returns (member ID, role IDs) pairs, role IDs are None for cached members. Empty at the end."""
+        if self.cached:
+            page = [(member_id, None) for member_id in self.targets[:self.limit]]
+            del self.targets[:self.limit]
+            return page
+        if self.after == "":
+            return []
+        route = Route('GET', '/guilds/{guild_id}/members', guild_id=self.job.server.id)
+        data = await self.http.request(route, params={"limit": self.limit, "after": self.after or "0"})
+        everyone = self.job.server.default_role.id
+        page = [(member["user"]["id"], member["roles"] + [everyone]) for member in data]
+        self.after = page[-1][0] if len(page) == self.limit else ""
+        return page
+
+class ProgressReporter:
+    """Edits a job's progress message on a fixed interval, however fast or slow the job goes.
+
+    Messages have their own rate limits, so none of this goes through the role change budget.
+    When the message can't be edited anymore, a single replacement is posted, and after that
+    the progress is only kept in `globalrole status`."""
+
+    def __init__(self, bot, job, interval):
+        self.bot = bot
+        self.job = job
+        self.interval = interval
+        self.msg = None
+        self.text = None
+        self.replaced = False
+        self.task = None
+
+    async def start(self):
+        await self.post()
+        self.task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.update()
+
+    async def post(self):
+        self.text = self.job.progress()
+        try:
+            self.msg = await self.bot.send_message(self.job.channel, self.text)
+        except discord.HTTPException:
+            self.msg = None
+
+    async def update(self):
+        text = self.job.progress()
+        if text == self.text:
+            return
+        if self.msg is not None:
+            try:
+                self.msg = await self.bot.edit_message(self.msg, new_content=text)
+                self.text = text
+                return
+            except discord.HTTPException:
+                self.msg = None
+        if not self.replaced:
+            self.replaced = True
+            await self.post()
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def finish(self):
+        self.cancel()
+        if self.msg is not None:
+            try:
+                await self.bot.delete_message(self.msg)
+            except discord.HTTPException:
+                pass
 
 class GlobalRole:
 
     def __init__(self, bot):
         self.bot = bot
-        self.stop = False
-        self.busy = False
+        self.concurrency = 4
+        self.slow_call = 1.0
+        self.bucket = TokenBucket()
+        self.scheduler = FairScheduler(bot.loop, self.bucket)
+        self.index = RoleIndex()
+        self.jobs = OrderedDict()
+        self.running = {}
+        self.queued = {}
+        self.next_id = 1
+        self.checkpoint_every = 250
+        self.progress_interval = 10.0
+        self.rates = dataIO.load_json('data/globalrole/rates.json')
+        saved = dataIO.load_json('data/globalrole/jobs.json')
+        self.next_id = max([data["id"] + 1 for data in saved] + [self.next_id])
+        self.bot.loop.create_task(self.resume_jobs(saved))
         self.reaction_yes = '\u2705'
         self.reaction_no = '\u274C'
 
@@ -44,138 +507,449 @@ class GlobalRole:
         await self.bot.say("Confirm_msg module error.")
         return False
 
+    async def apply(self, job, member_id, role_ids):
+        """Makes the job's change to a member whose roles were `role_ids` when they were queued.
+
+        Returns whether it went through, None when there's nothing left to change."""
+        add, remove = job.changes(role_ids)
+        for attempt in range(5):
+            await self.scheduler.acquire(job.id)
+            try:
+                if len(add) + len(remove) == 1:
+                    # a single role has its own endpoint, which leaves the other roles alone however old `role_ids` is
+                    started = time.monotonic()
+                    if add:
+                        await self.bot.http.add_role(job.server.id, member_id, add[0])
+                    else:
+                        await self.bot.http.remove_role(job.server.id, member_id, remove[0])
+                else:
+                    # one member edit covers every role of the job, but it replaces the whole list: read it
+                    # right before, or whatever changed since it was queued (like a mute) would be reverted
+                    role_ids = await self.member_roles(job, member_id)
+                    if role_ids is None or not job.needs_change(self.index.mask_ids(job.server, role_ids)):
+                        return None
+                    started = time.monotonic()
+                    await self.bot.http.replace_roles(member_id, job.server.id, job.new_roles(role_ids))
+            except (discord.Forbidden, discord.NotFound):
+                return False
+            except discord.HTTPException as e:
+                status = getattr(e.response, "status", 0)
+                if status != 429 and status < 500:
+                    return False
+                retry_after = None
+                if status == 429:
+                    try:
+                        retry_after = float(e.response.headers.get("Retry-After"))
+                    except (AttributeError, TypeError, ValueError):
+                        pass
+                self.bucket.throttle(retry_after)
+                await asyncio.sleep(min(30, 2 ** attempt) + random.random())
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # the connection dropped, replacing the roles again is harmless if the edit went through
+                await asyncio.sleep(min(30, 2 ** attempt) + random.random())
+                continue
+            # discord.py waits out exhausted buckets on its own, so a slow call means we're too fast
+            if time.monotonic() - started > self.slow_call:
+                self.bucket.throttle()
+            else:
+                self.bucket.relax()
+            return True
+        return False
+
+    async def member_roles(self, job, member_id):
+        """The current role IDs of a member, None if they left the server."""
+        member = job.server.get_member(member_id)
+        if member is not None:
+            return [role.id for role in member.roles]
+        route = Route('GET', '/guilds/{guild_id}/members/{user_id}', guild_id=job.server.id, user_id=member_id)
+        try:
+            data = await self.bot.http.request(route)
+        except discord.NotFound:
+            return None
+        return data["roles"] + [job.server.default_role.id]
+
+    def __unload(self):
+        self.save_jobs()
+        for job in self.running.values():
+            if job.task is not None:
+                job.task.cancel()
+
+    def save_jobs(self):
+        dataIO.save_json('data/globalrole/jobs.json', [job.to_json() for job in self.jobs.values()])
+
+    async def resume_jobs(self, saved):
+        await self.bot.wait_until_ready()
+        for data in saved:
+            job = RoleJob.from_json(self.bot, data)
+            if job is not None:
+                self.submit(job)
+        self.save_jobs()
+
+    def record_rate(self, job):
+        # plan divides the members to change by this, so it's member edits per second - streamed
+        # jobs also go through every member that needs no change, which costs next to nothing
+        changed = job.changed - job.changed_base
+        if changed < 50:
+            return  # too short to tell the sustained rate from the initial burst
+        rate = changed / (time.monotonic() - job.started)
+        previous = self.rates.get(job.server.id)
+        self.rates[job.server.id] = rate if previous is None else previous * 0.7 + rate * 0.3
+        dataIO.save_json('data/globalrole/rates.json', self.rates)
+
+    def plan(self, job, member_count):
+        """Fills in the embed fields shown before an operation: what it changes, what it costs and how long it takes."""
+        ahead = 0
+        for other in self.jobs.values():
+            if other.server.id == job.server.id and other is not job:
+                ahead += other.total - other.count if other.started is not None else len(self.index.targets(other.server, other))
+        rate = self.rates.get(job.server.id)
+        measured = rate is not None
+        if not measured:
+            rate = self.bucket.rate
+        fields = []
+        if job.filter is not None:
+            matching = len(self.index.matching(job.server, job.match))
+            fields.append(("Matching members", str(matching)))
+        calls = "{} member edits + {} progress updates"
+        if self.index.complete(job.server):
+            fields.append(("Members to change", str(member_count)))
+        else:
+            # the rest of the server is paged through while the job runs, assume it looks like the cached part
+            cached = len(job.server.members)
+            member_count = member_count * job.server.member_count // max(1, cached)
+            fields.append(("Members to change", "~{} (from the {} of {} members cached)".format(member_count, cached, job.server.member_count)))
+            calls += " + {} member list pages".format(job.server.member_count // 1000 + 1)
+        fields.append(("API calls", calls.format(member_count, int(member_count / rate / self.progress_interval) + 2)))
+        remaining = (ahead + member_count) / rate
+        eta = "{}m {}s".format(int(remaining // 60), int(remaining % 60))
+        if measured:
+            eta += " (at {:.1f} member edits/s measured on this server)".format(rate)
+        else:
+            eta += " (at {:.1f} member edits/s, nothing measured on this server yet)".format(rate)
+        if ahead:
+            eta += "\nincluding {} members of operations queued ahead".format(ahead)
+        fields.append(("Estimated time", eta))
+        return fields
+
+    async def worker(self, job, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            member_id, role_ids = item
+            member = job.server.get_member(member_id)
+            if member is not None:
+                role_ids = [role.id for role in member.roles]   # fresher than a fetched page
+            if not job.stop and role_ids is not None and job.needs_change(self.index.mask_ids(job.server, role_ids)):
+                try:
+                    changed = await self.apply(job, member_id, role_ids)
+                except Exception as e:
+                    # a dead worker would leave execute waiting on a full queue for good
+                    print("GlobalRole: failed to change the roles of member {}: {}".format(member_id, e))
+                    changed = False
+                if changed:
+                    job.changed += 1
+                elif changed is False:
+                    job.failed += 1     # None when the member left or doesn't need the change anymore
+            job.count += 1
+            job.complete(member_id)
+
+    def submit(self, job):
+        self.jobs[job.id] = job
+        if job.server.id in self.running:
+            self.queued.setdefault(job.server.id, deque()).append(job)
+            return len(self.queued[job.server.id])
+        self.start(job)
+        return 0
+
+    def start(self, job):
+        self.running[job.server.id] = job
+        job.task = self.bot.loop.create_task(self.run_job(job))
+
+    async def run_job(self, job):
+        unloading = False
+        try:
+            await self.execute(job)
+        except asyncio.CancelledError:
+            unloading = True    # the last checkpoint resumes the job
+        except Exception as e:
+            try:
+                await self.bot.send_message(job.channel, "Job #{} failed: {}".format(job.id, e))
+            except asyncio.CancelledError:
+                unloading = True
+            except Exception:
+                pass    # likely why the job failed, like a channel locked on us
+        finally:
+            # the server would stay busy for good otherwise, with its queued jobs never starting
+            if not unloading:
+                self.finish(job)
+
+    def finish(self, job):
+        """Forgets a job that ended and starts the next one queued on its server."""
+        del self.jobs[job.id]
+        del self.running[job.server.id]
+        queue = self.queued.get(job.server.id)
+        if queue:
+            next_job = queue.popleft()
+            if not queue:
+                del self.queued[job.server.id]
+            self.start(next_job)
+        self.save_jobs()
+
+    async def execute(self, job):
+        stream = MemberStream(self.bot.http, self.index, job)   # re-planned, the job might have been queued for a while
+        job.total = member_count = stream.total
+        job.base = checkpoint = job.count
+        job.changed_base = job.changed
+        job.started = time.monotonic()
+        reporter = ProgressReporter(self.bot, job, self.progress_interval)
+        await reporter.start()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [self.bot.loop.create_task(self.worker(job, queue)) for _ in range(self.concurrency)]
+        try:
+            page = await stream.next_page()
+            while page and not job.stop:
+                for member_id, role_ids in page:
+                    if job.stop == True:
+                        break
+                    if role_ids is not None and not job.needs_change(self.index.mask_ids(job.server, role_ids)):
+                        job.count += 1
+                        job.complete(member_id)
+                        continue
+                    job.inflight[member_id] = False
+                    await queue.put((member_id, role_ids))
+                    if job.count - checkpoint >= self.checkpoint_every:
+                        checkpoint = job.count
+                        self.save_jobs()
+                page = await stream.next_page()
+            for worker in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            reporter.cancel()
+        self.record_rate(job)
+        count = job.count
+        await reporter.finish()
+        if job.stop == True:
+            await self.bot.send_message(job.channel, "Operation aborted by the user! ({}/{})".format(count, member_count))
+            return
+        await self.bot.send_message(job.channel, job.done_text.format(*job.names, count, member_count))
+
+    def describe(self, job):
+        if job.started is None:
+            return "#{} queued: {} `{}`".format(job.id, job.operation, "`;`".join(job.names))
+        return "#{} running: {} `{}` ({}/{}){}".format(job.id, job.operation, "`;`".join(job.names), job.count, job.total, job.eta())
+
     @commands.group(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_roles=True)
     async def globalrole(self, ctx, operation: str, *, role: str=None):
-        """Add or remove a role from all members. Use 'add', 'remove' or 'stop' as operations.
+        """Add or remove a role from all members. Use 'add', 'remove', 'set', 'plan', 'count', 'status' or 'stop' as operations.
+        Filters are role expressions using & (and), | (or), ! (not) and parentheses, quote role names containing these.
         Examples:
         globalrole add All          - adds the All role to all members
         globalrole remove Other     - removes the Other role from all members
         globalrole add Other;All    - adds the Other role to all members with the All role
         globalrole remove All;Other - removes the All role from all members with the Other role
-        globalrole stop             - stops the current operation"""
-        valid_operations = ["add", "remove", "stop"]
+        globalrole add EU;Member & !Muted & (Germany | France)
+                                    - adds the EU role to unmuted members from Germany or France
+        globalrole set +A;+B;-C     - adds the A and B roles and removes the C role, one edit per member
+        globalrole set +A;-C;Other  - the same, but only for members with the Other role
+        globalrole plan set +A;-C   - shows what an operation would change, cost and take, without running it
+        globalrole count A & !B     - counts the members matching a filter, without changing anything
+        globalrole status           - lists the running and queued operations
+        globalrole stop             - stops the current operation
+        globalrole stop 3           - stops or unqueues operation #3"""
+        valid_operations = ["add", "remove", "set", "plan", "count", "status", "stop"]
         server = ctx.message.server
         author = ctx.message.author
         channel = ctx.message.channel
         operation = operation.lower()
+        dry_run = operation == "plan"
+        if dry_run:
+            operation, _, role = (role or "").partition(" ")
+            operation = operation.lower()
+            role = role or None
+            if operation not in ("add", "remove", "set"):
+                await self.bot.send_cmd_help(ctx)
+                return
         if operation not in valid_operations:
             list_str = ", ".join(valid_operations)
             await self.bot.say("Invalid operation! Valid operations are:\n```\n" + list_str + "\n```")
             return
+        if operation == "status":
+            jobs = [job for job in self.jobs.values() if job.server.id == server.id]
+            if not jobs:
+                await self.bot.say("There are no operations running right now!")
+                return
+            await self.bot.say("```\n" + "\n".join(self.describe(job) for job in jobs) + "\n```")
+            return
         if operation == "stop":
-            self.stop = self.busy
-            if self.stop == True:
-                await self.bot.say("Stopping...")
+            if role is None:
+                job = self.running.get(server.id)
             else:
+                job = self.jobs.get(int(role)) if role.isdigit() else None
+                if job is not None and job.server.id != server.id:
+                    job = None
+            if job is None:
                 await self.bot.say("There are no operations running right now!")
-            return
-        if self.busy == True:
-            await self.bot.say("Operation already running - check the last message for progress!\nUse `[p]globalrole stop` to stop the current operation.")
+            elif job.started is None and job in self.queued.get(server.id, ()):
+                self.queued[server.id].remove(job)
+                if not self.queued[server.id]:
+                    del self.queued[server.id]
+                del self.jobs[job.id]
+                self.save_jobs()
+                await self.bot.say("Operation #{} removed from the queue.".format(job.id))
+            else:
+                job.stop = True
+                await self.bot.say("Stopping...")
             return
         if role is None:
             await self.bot.send_cmd_help(ctx)
             return
-        frole = None
-        if ';' in role:
-            role = role.split(';')
-            if len(role) > 2:
-                await self.bot.send_cmd_help(ctx)
+        if operation == "count":
+            try:
+                rfilter = RoleFilter(role, server.roles)
+            except ValueError as e:
+                await self.bot.say(str(e))
                 return
-            frole = role[1]
-            role = role[0]
-        role = discord.utils.get(server.roles, name=role)
-        if role is None:
+            match = rfilter.compile(lambda roles: self.index.mask(server, roles))
+            member_count = len(self.index.matching(server, match))
+            if self.index.complete(server):
+                await self.bot.say("{} server members match `{}`.".format(member_count, rfilter.text))
+                return
+            # like plan, assume the members missing from the cache look like the cached ones
+            cached = len(server.members)
+            estimate = member_count * server.member_count // max(1, cached)
+            await self.bot.say("{} of the {} cached server members match `{}`, about {} of all {} members.".format(member_count, cached, rfilter.text, estimate, server.member_count))
+            return
+        rfilter = None
+        add = []
+        remove = []
+        if operation == "set":
+            for name in role.split(';'):
+                if name[:1] in ("+", "-"):
+                    (add if name[0] == "+" else remove).append(name[1:])
+                elif rfilter is None:
+                    rfilter = name
+                else:
+                    await self.bot.send_cmd_help(ctx)
+                    return
+        else:
+            if ';' in role:
+                role, rfilter = role.split(';', 1)
+            (add if operation == "add" else remove).append(role)
+        if not add and not remove:
+            await self.bot.send_cmd_help(ctx)
+            return
+        add = [discord.utils.get(server.roles, name=name) for name in add]
+        remove = [discord.utils.get(server.roles, name=name) for name in remove]
+        if None in add or None in remove:
             await self.bot.say("That role doesn't seem to exist!")
             return
+        if any(role in remove for role in add):
+            await self.bot.say("A role can't be both added and removed!")
+            return
         if not server.me.server_permissions.manage_roles:
             await self.bot.say("I don't have the MANAGE_ROLES permission!")
             return
-        if role >= author.top_role:
-            await self.bot.say("That role is higher or equal with your highest role - You can't manage that!")
-            return
-        if role >= server.me.top_role:
-            await self.bot.say("That role is higher or equal with my highest role - I can't manage that!")
-            return
-        if frole is not None:
-            frole = discord.utils.get(server.roles, name=frole)
-            if frole is None:
-                await self.bot.say("That role doesn't seem to exist!")
+        for role in add + remove:
+            if role.is_everyone:
+                await self.bot.say("The @everyone role can't be added or removed!")
+                return
+            if role >= author.top_role:
+                await self.bot.say("That role is higher or equal with your highest role - You can't manage that!")
                 return
+            if role >= server.me.top_role:
+                await self.bot.say("That role is higher or equal with my highest role - I can't manage that!")
+                return
+        if rfilter is not None:
+            try:
+                rfilter = RoleFilter(rfilter, server.roles)
+            except ValueError as e:
+                await self.bot.say(str(e))
+                return
+        job = RoleJob(self.next_id, server, channel, operation, add, remove, rfilter)
+        self.next_id += 1
+        member_count = len(self.index.targets(server, job))
+        if member_count == 0 and self.index.complete(server):
+            await self.bot.say("There are no members that need this change!")
+            return
         if operation == "add":
-            if frole is None:
-                text = "Adding `{}` role to all server members... ({}/{})"
-                desc = "You are about to add the `{}` role to all server members. Proceed?".format(role.name)
+            if rfilter is None:
+                job.text = "Adding `{}` role to all server members... ({}/{})"
+                job.done_text = "Added `{}` role to all server members! ({}/{})"
+                desc = "You are about to add the `{}` role to {} server members. Proceed?".format(job.names[0], member_count)
             else:
-                text = "Adding `{}` role to all server members with `{}` role... ({}/{})"
-                desc = "You are about to add the `{}` role to all server members with the `{}` role. Proceed?".format(role.name, frole.name)
+                job.text = "Adding `{}` role to all server members matching `{}`... ({}/{})"
+                job.done_text = "Added `{}` role to all server members matching `{}`! ({}/{})"
+                desc = "You are about to add the `{}` role to {} server members matching `{}`. Proceed?".format(job.names[0], member_count, rfilter.text)
         elif operation == "remove":
-            if frole is None:
-                text = "Removing `{}` role from all server members... ({}/{})"
-                desc = "You are about to remove the `{}` role from all server members. Proceed?".format(role.name)
+            if rfilter is None:
+                job.text = "Removing `{}` role from all server members... ({}/{})"
+                job.done_text = "Removed `{}` role from all server members! ({}/{})"
+                desc = "You are about to remove the `{}` role from {} server members. Proceed?".format(job.names[0], member_count)
+            else:
+                job.text = "Removing `{}` role from all server members matching `{}`... ({}/{})"
+                job.done_text = "Removed `{}` role from all server members matching `{}`! ({}/{})"
+                desc = "You are about to remove the `{}` role from {} server members matching `{}`. Proceed?".format(job.names[0], member_count, rfilter.text)
+        elif operation == "set":
+            if rfilter is None:
+                job.text = "Changing `{}` roles of all server members... ({}/{})"
+                job.done_text = "Changed `{}` roles of all server members! ({}/{})"
+                desc = "You are about to change the `{}` roles of {} server members. Proceed?".format(job.names[0], member_count)
             else:
-                text = "Removing `{}` role from all server members with `{}` role... ({}/{})"
-                desc = "You are about to remove the `{}` role from all server members with the `{}` role. Proceed?".format(role.name, frole.name)
+                job.text = "Changing `{}` roles of all server members matching `{}`... ({}/{})"
+                job.done_text = "Changed `{}` roles of all server members matching `{}`! ({}/{})"
+                desc = "You are about to change the `{}` roles of {} server members matching `{}`. Proceed?".format(job.names[0], member_count, rfilter.text)
         e = discord.Embed(description=desc)
+        for name, value in self.plan(job, member_count):
+            e.add_field(name=name, value=value)
+        if dry_run:
+            e.set_author(name=server.name, icon_url=server.icon_url)
+            e.set_footer(text="Dry run - nothing was changed.")
+            await self.bot.say(embed=e)
+            return
         confirm = await self.confirm_msg(ctx, e, 60)
         if confirm is False:
             return
-        count = 0
-        proc_count = 0
-        member_count = len(server.members)
-        if frole is None:
-            msg = await self.bot.say(text.format(role.name, count, member_count))
-        else:
-            msg = await self.bot.say(text.format(role.name, frole.name, count, member_count))
-        self.busy = True
-        for member in server.members:
-            if operation == "add" and role not in member.roles:
-                if frole is None:
-                    await self.bot.add_roles(member, role)
-                    proc_count += 1
-                elif frole in member.roles:
-                    await self.bot.add_roles(member, role)
-                    proc_count += 1
-            elif operation == "remove" and role in member.roles:
-                if frole is None:
-                    await self.bot.remove_roles(member, role)
-                    proc_count += 1
-                elif frole in member.roles:
-                    await self.bot.remove_roles(member, role)
-                    proc_count += 1
-            count += 1
-            if count % 100 == 0 or proc_count >= 10:
-                proc_count = 0
-                try:
-                    if frole is None:
-                        msg = await self.bot.edit_message(msg, new_content=text.format(role.name, count, member_count))
-                    else:
-                        msg = await self.bot.edit_message(msg, new_content=text.format(role.name, frole.name, count, member_count))
-                except:
-                    if frole is None:
-                        msg = await self.bot.say(text.format(role.name, count, member_count))
-                    else:
-                        msg = await self.bot.say(text.format(role.name, frole.name, count, member_count))
-                member_count = len(server.members)
-            if self.stop == True:
-                break
-        self.busy = False
-        if msg is not None:
-            await self.bot.delete_message(msg)
-        if self.stop == True:
-            await self.bot.say("Operation aborted by the user! ({}/{})".format(count, member_count))
-            self.stop = False
-            return
-        if operation == "add":
-            if frole is None:
-                await self.bot.say("Added `{}` role to all server members! ({}/{})".format(role.name, count, member_count))
-            else:
-                await self.bot.say("Added `{}` role to all server members with the `{}` role! ({}/{})".format(role.name, frole.name, count, member_count))
-        elif operation == "remove":
-            if frole is None:
-                await self.bot.say("Removed `{}` role from all server members! ({}/{})".format(role.name, count, member_count))
-            else:
-                await self.bot.say("Removed `{}` role from all server members with the `{}` role! ({}/{})".format(role.name, frole.name, count, member_count))
+        position = self.submit(job)
+        self.save_jobs()
+        if position > 0:
+            await self.bot.say("Operation #{} queued - {} operation(s) ahead of it on this server.\nUse `[p]globalrole status` to check on it.".format(job.id, position))
+
+    async def on_member_join(self, member):
+        self.index.add(member)
+
+    async def on_member_remove(self, member):
+        self.index.remove(member)
+
+    async def on_member_update(self, before, after):
+        self.index.update(before, after)
+
+    async def on_server_role_delete(self, role):
+        self.index.remove_role(role)
+
+def check_folders():
+    paths = ["data/globalrole"]
+    for path in paths:
+        if not os.path.exists(path):
+            print("Creating {} folder...".format(path))
+            os.makedirs(path)
+
+def check_files():
+    f = "data/globalrole/jobs.json"
+    if not dataIO.is_valid_json(f):
+        print("Creating default jobs.json...")
+        dataIO.save_json(f, [])
+    f = "data/globalrole/rates.json"
+    if not dataIO.is_valid_json(f):
+        print("Creating default rates.json...")
+        dataIO.save_json(f, {})
 
 def setup(bot):
+    check_folders()
+    check_files()
     bot.add_cog(GlobalRole(bot))
\ No newline at end of file
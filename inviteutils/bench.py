@@ -0,0 +1,227 @@
+"""Offline benchmarks of the InviteUtils cog.
+
+Scenarios:
+    deltas  - the invite use delta pass and the settings migration on a server with
+              thousands of invites, against the per-join URL scan they replaced
+    joins   - join to role latency through the cog and a stand-in bot, with bursts of joins,
+              invite uses lagging behind the join events and role calls failing with 404
+    templates - renders of a long join message through MessageTemplate against str.format
+
+Run it from the Red directory, so that `discord` and `cogs.utils` can be imported:
+
+    python path/to/inviteutils/bench.py deltas --invites 5000
+    python path/to/inviteutils/bench.py joins --joins 100 --lagged 0.25 --fail 0.3
+    python path/to/inviteutils/bench.py templates --copies 20
+"""
+import os
+import sys
+import random
+import shutil
+import timeit
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.getcwd())
+
+import discord
+import inviteutils
+
+class Stub:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+class FakeServer(Stub):
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+class FakeBot:
+    """Stands in for the bot. API calls take `latency` seconds give or take half of it, and the
+    first role call for a member fails with a 404 at the `fail` rate, like it does for members
+    Discord hasn't finished adding yet."""
+
+    def __init__(self, loop, rng, latency=0.08, fail=0.3):
+        self.loop = loop
+        self.rng = rng
+        self.latency = latency
+        self.fail = fail
+        self.servers = []
+        self.invites = {}
+        self.roles = {}
+        self.tried = set()
+        self.calls = Counter()
+
+    async def request(self, name):
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+
+    async def wait_until_ready(self):
+        pass
+
+    async def invites_from(self, server):
+        await self.request("invites_from")
+        return [Stub(code=code, url="http://discord.gg/" + code, uses=uses, inviter=Stub(name="inviter")) for code, uses in self.invites.items()]
+
+    async def add_roles(self, member, *roles):
+        await self.request("add_roles")
+        if member.id not in self.tried:
+            self.tried.add(member.id)
+            if self.rng.random() < self.fail:
+                raise discord.NotFound(Stub(status=404, reason="Not Found"), "Unknown Member")
+        self.roles[member.id] = roles[0].id
+
+    async def send_message(self, channel, content=None, embed=None):
+        await self.request("send_message")
+
+def best(function, repeat, number):
+    """Seconds per call of the fastest of `repeat` runs."""
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+def url_scan(stored, invites):
+    # how joins were attributed before the database was keyed by code: a URL keyed
+    # database with the uses stored as text, scanned on every join for an invite one use up
+    found = []
+    for inv in invites:
+        if inv.url in stored and int(inv.uses) == int(stored[inv.url]["uses"]) + 1:
+            found.append(inv)
+    return found
+
+def bench_deltas(args):
+    rng = random.Random(args.seed)
+    stored = {}
+    invites = []
+    for i in range(args.invites):
+        code = "c{:06}".format(i)
+        uses = rng.randint(0, 1000)
+        stored[code] = {"uses": uses}
+        invites.append(Stub(code=code, url="http://discord.gg/" + code, uses=uses + (i % args.every == 0)))
+    changed = [inv for i, inv in enumerate(invites) if i % args.every == 0]
+    by_url = {inv.url: {"uses": str(stored[inv.code]["uses"])} for inv in invites}
+    if [inv for inv, delta in inviteutils.invite_deltas(stored, invites)] != changed or url_scan(by_url, invites) != changed:
+        sys.exit("FAILED: the delta pass and the URL scan don't find the same invites")
+    deltas = best(lambda: inviteutils.invite_deltas(stored, invites), args.repeat, args.number)
+    scan = best(lambda: url_scan(by_url, invites), args.repeat, args.number)
+    # migrate only needs the settings and a save, run it on a stand-in for the cog
+    def migrate():
+        cog = Stub(set={"server": {"invites": {url: dict(data) for url, data in by_url.items()}}}, save=lambda: None)
+        inviteutils.InviteUtils.migrate(cog)
+    migration = best(migrate, args.repeat, 1)
+    print("{} invites, {} of them used since the last snapshot".format(args.invites, len(changed)))
+    print("invite_deltas: {:.3f}ms per join window".format(deltas * 1000))
+    print("URL scan it replaced: {:.3f}ms per join".format(scan * 1000))
+    print("Migrating a URL keyed database: {:.1f}ms, once".format(migration * 1000))
+
+async def run_joins(args):
+    loop = asyncio.get_event_loop()
+    rng = random.Random(args.seed)
+    bot = FakeBot(loop, rng, args.latency / 1000, args.fail)
+    codes = ["inv{}".format(i) for i in range(args.invites)]
+    server = FakeServer(id="1", name="server", channels={"2": Stub(id="2", name="welcome")})
+    server.roles = [Stub(id="r" + code, name="Role of " + code) for code in codes]
+    bot.servers.append(server)
+    bot.invites = {code: 0 for code in codes}
+    cog = inviteutils.InviteUtils(bot)
+    await cog.load_task
+    cog.server_init(server)
+    cog.set[server.id].update({"channel": "2", "join": True, "invites": {code: {"uses": 0, "role": "r" + code} for code in codes}})
+    used = {}
+
+    async def use(code):
+        if rng.random() < args.lagged:
+            await asyncio.sleep(args.lag)    # the invite uses can lag behind the join event
+        bot.invites[code] += 1
+
+    joined = 0
+    while joined < args.joins:
+        code = rng.choice(codes)    # a burst is people following the same link
+        for _ in range(min(rng.randint(1, args.burst), args.joins - joined)):
+            member = Stub(id=str(1000 + joined), name="member", mention="<@{}>".format(1000 + joined), avatar_url="", bot=False, server=server)
+            used[member.id] = code
+            loop.create_task(use(code))
+            loop.create_task(cog.on_member_join(member))    # like discord.py, a listener task per event
+            joined += 1
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(rng.uniform(0, 2 * args.interval))
+    current = asyncio.Task.current_task() if hasattr(asyncio.Task, "current_task") else asyncio.current_task()
+    all_tasks = asyncio.Task.all_tasks if hasattr(asyncio.Task, "all_tasks") else asyncio.all_tasks
+    while True:
+        pending = [task for task in all_tasks() if task is not current and not task.done()]
+        if not pending:
+            break
+        await asyncio.wait(pending)
+    wrong = sum(1 for member_id, role_id in bot.roles.items() if role_id != "r" + used[member_id])
+    print("{} joins in {} windows, {} got a role ({} wrong)".format(args.joins, cog.windows, len(bot.roles), wrong))
+    print("Undetermined invite: {} joins ({:.0%}), {} ({:.0%}) without their role".format(cog.undetermined, cog.undetermined / args.joins, args.joins - len(bot.roles), 1 - len(bot.roles) / args.joins))
+    for name, timings in (("Join to role", cog.join_timings), ("Window", cog.window_timings), ("Invite snapshot", cog.snapshot_timings), ("Role call", cog.role_timings)):
+        print("{}: p50 {:.0f}ms p99 {:.0f}ms".format(name, timings.percentile(50) * 1000, timings.percentile(99) * 1000))
+    print("Retries: {} invite snapshots, {} role calls".format(cog.snapshot_retries, cog.role_retries))
+    print("API calls: " + ", ".join("{} {}".format(name, calls) for name, calls in bot.calls.most_common()))
+    if wrong:
+        sys.exit("FAILED: members got the role of an invite they didn't use")
+
+def bench_joins(args):
+    cwd = os.getcwd()
+    data = tempfile.mkdtemp()
+    os.chdir(data)     # the cog keeps its files under data/inviteutils relative to the working directory
+    try:
+        inviteutils.check_folder()
+        inviteutils.check_file()
+        asyncio.get_event_loop().run_until_complete(run_joins(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(data)
+
+# 7 fields in 182 characters, a line of a long welcome message
+TEMPLATE_LINE = ("Welcome {0.mention} ({0.name}#{0.discriminator}) to {1.name}! You joined through "
+                 "{2.code}, made by {2.inviter.name}, and got the {3.name} role. Read the rules and say hi to everyone\n")
+
+def bench_templates(args):
+    text = TEMPLATE_LINE * args.copies
+    inviter = Stub(name="inviter")
+    arguments = (Stub(mention="<@1000>", name="member", discriminator="0001"), Stub(name="server"),
+                 Stub(code="inv0", inviter=inviter), Stub(name="Role of inv0"))
+    template = inviteutils.MessageTemplate(text, inviteutils.JOIN_ARGUMENTS)
+    if template.render(*arguments) != text.format(*arguments):
+        sys.exit("FAILED: MessageTemplate and str.format render differently")
+    fields = sum(1 for literal, field, spec, conversion in inviteutils.Formatter().parse(text) if field is not None)
+    plain = best(lambda: text.format(*arguments), args.repeat, args.number)
+    compiled = best(lambda: template.render(*arguments), args.repeat, args.number)
+    print("{}-character template, {} fields, {} distinct".format(len(text), fields, len(template.getters)))
+    print("str.format: {:.1f}k renders/s".format(1 / plain / 1000))
+    print("MessageTemplate: {:.1f}k renders/s".format(1 / compiled / 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the InviteUtils cog.")
+    scenarios = parser.add_subparsers(dest="scenario")
+    deltas = scenarios.add_parser("deltas", help="invite use deltas on a server with many invites")
+    deltas.add_argument("--invites", type=int, default=5000)
+    deltas.add_argument("--every", type=int, default=1000, help="every how many invites one was used")
+    deltas.add_argument("--repeat", type=int, default=5)
+    deltas.add_argument("--number", type=int, default=100, help="calls per timed run")
+    deltas.add_argument("--seed", type=int, default=0)
+    deltas.set_defaults(run=bench_deltas)
+    joins = scenarios.add_parser("joins", help="join to role latency with a stand-in bot")
+    joins.add_argument("--joins", type=int, default=100)
+    joins.add_argument("--invites", type=int, default=2, help="invites in use, each giving its own role")
+    joins.add_argument("--burst", type=int, default=4, help="most members joining at once")
+    joins.add_argument("--interval", type=float, default=1.5, help="average seconds between bursts")
+    joins.add_argument("--lagged", type=float, default=0.25, help="share of invite uses showing up late")
+    joins.add_argument("--lag", type=float, default=0.8, help="seconds a late invite use takes to show up")
+    joins.add_argument("--fail", type=float, default=0.3, help="share of first role calls failing with 404")
+    joins.add_argument("--latency", type=float, default=80, help="API latency in milliseconds")
+    joins.add_argument("--seed", type=int, default=0)
+    joins.set_defaults(run=bench_joins)
+    templates = scenarios.add_parser("templates", help="renders of a long join message")
+    templates.add_argument("--copies", type=int, default=20, help="times the 7 field line is repeated")
+    templates.add_argument("--repeat", type=int, default=3)
+    templates.add_argument("--number", type=int, default=20000, help="renders per timed run")
+    templates.set_defaults(run=bench_templates)
+    args = parser.parse_args()
+    if args.scenario is None:
+        parser.print_help()
+        return
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
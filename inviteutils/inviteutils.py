@@ -1,19 +1,157 @@
 ﻿import os
+import re
+import time
 import discord
 import asyncio
 from cogs.utils import checks
 from discord.ext import commands
 from random import choice, randint
+from string import Formatter
+from operator import attrgetter
+from collections import deque
 from cogs.utils.dataIO import dataIO
 
+def invite_code(invite):
+    """The code of an invite given as a code or any discord.gg / discordapp.com URL."""
+    return invite.strip().rstrip('/').rsplit('/', 1)[-1]
+
+def invite_deltas(stored, invites):
+    """Every invite whose uses changed since they were stored, with the change, in one pass.
+
+    `stored` is the invite database of a server, keyed by code. Invites it doesn't know yet
+    count from zero."""
+    deltas = []
+    for inv in invites:
+        data = stored.get(inv.code)
+        delta = inv.uses - (data["uses"] if data is not None else 0)
+        if delta:
+            deltas.append((inv, delta))
+    return deltas
+
+# the arguments of the join/leave messages, with the class their first attribute is checked against
+JOIN_ARGUMENTS = (("user", discord.Member), ("server", discord.Server), ("invite", discord.Invite), ("role", discord.Role))
+LEAVE_ARGUMENTS = JOIN_ARGUMENTS[:2]
+
+def field_getter(steps):
+    """A function following a field's (attribute, index) steps from its argument."""
+    if all(attribute is not None for attribute, index in steps):
+        return attrgetter(".".join(attribute for attribute, index in steps))
+    def getter(value):
+        for attribute, index in steps:
+            value = getattr(value, attribute) if attribute is not None else value[index]
+        return value
+    return getter
+
+class MessageTemplate:
+    """A join/leave message parsed and validated once, rendering only the attributes it uses.
+
+    Fields work like in str.format, except that private attributes and non-numeric
+    indexes are rejected. Every distinct field is read once per render and the result
+    is filled into a flat positional format string, so long messages cost about as much
+    as their field count."""
+
+    FIELD_PART = re.compile(r'\.([^.\[]+)|\[(\d+)\]')
+
+    def __init__(self, text, arguments):
+        self.text = text
+        self.getters = []   # (argument index, attrgetter or None), one per distinct field
+        positions = {}
+        flat = []
+        try:
+            parsed = list(Formatter().parse(text))
+        except ValueError as e:
+            raise ValueError("The braces don't match up ({}). Use {{{{ and }}}} for literal braces.".format(e))
+        auto = 0
+        numbered = False
+        for literal, field, spec, conversion in parsed:
+            flat.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            if field == "" or field[0] in ".[":
+                if numbered:
+                    raise ValueError("Empty `{}` fields can't be mixed with numbered ones.")
+                field = str(auto) + field
+                auto += 1
+            elif auto:
+                raise ValueError("Empty `{}` fields can't be mixed with numbered ones.")
+            else:
+                numbered = True
+            index = re.match(r'\d*', field).group()
+            if not index or int(index) >= len(arguments):
+                raise ValueError("`{{{}}}` isn't a valid field, only {{0}} to {{{}}} can be used.".format(field, len(arguments) - 1))
+            steps = []
+            position = len(index)
+            while position < len(field):
+                part = self.FIELD_PART.match(field, position)
+                if part is None:
+                    raise ValueError("`{{{}}}` isn't a valid field.".format(field))
+                attribute, item = part.groups()
+                if attribute is not None and attribute.startswith('_'):
+                    raise ValueError("`{{{}}}` isn't a valid field, attributes starting with `_` can't be used.".format(field))
+                steps.append((attribute, int(item) if item is not None else None))
+                position = part.end()
+            name, cls = arguments[int(index)]
+            if steps and steps[0][0] is not None and not hasattr(cls, steps[0][0]):
+                raise ValueError("`{{{}}}` isn't a valid field, the {} has no `{}`.".format(field, name, steps[0][0]))
+            if conversion not in (None, "s", "r"):
+                raise ValueError("`!{}` isn't a valid conversion, use `!s` or `!r`.".format(conversion))
+            if '{' in spec:
+                raise ValueError("Fields can't be nested inside `{{{}:{}}}`.".format(field, spec))
+            position = positions.get(field)
+            if position is None:
+                position = positions[field] = len(self.getters)
+                self.getters.append((int(index), field_getter(steps) if steps else None))
+            flat.append("{" + str(position) + ("!" + conversion if conversion else "") + (":" + spec if spec else "") + "}")
+        self.flat = "".join(flat)
+
+    def render(self, *args):
+        return self.flat.format(*[args[index] if getter is None else getter(args[index]) for index, getter in self.getters])
+
+class Timings:
+    """Rolling window of durations, used for the percentiles shown by `invutils metrics`."""
+
+    def __init__(self, size=2000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
 class InviteUtils:
     def __init__(self, bot):
         self.bot = bot
         self.set = dataIO.load_json('data/inviteutils/settings.json')
+        self.migrate()
         self.joinmessage_color = 65280
         self.leavemessage_color = 16711680
+        self.join_embed = {"title": "Member Joined!", "color": self.joinmessage_color}
+        self.leave_embed = {"title": "Member Left!", "color": self.leavemessage_color}
+        self.templates = {}
         self.reaction_yes = '\u2705'
         self.reaction_no = '\u274C'
+        self.join_window = 2.0
+        self.join_quiet = 0.3
+        self.join_windows = {}              # the open window of each server, taking joins
+        self.closing_windows = {}           # windows of each server waiting for or taking their snapshot, in order
+        self.snapshot_locks = {}
+        self.window_timings = Timings()     # join until the invite snapshot is in
+        self.snapshot_timings = Timings()   # fetching the invite list
+        self.role_timings = Timings()       # adding the role, with retries
+        self.join_timings = Timings()       # join until the role is added
+        self.windows = 0
+        self.undetermined = 0               # joins whose invite couldn't be determined
+        self.snapshot_retries = 0
+        self.role_retries = 0
+        self.sync_concurrency = 8
+        self.unsynced = set(self.set)       # configured servers the startup sync hasn't got to yet
+        self.pending_joins = {}
         self.load_task = self.bot.loop.create_task(self.on_load_tasks())
 
     def __unload(self):
@@ -24,6 +162,29 @@ class InviteUtils:
 
     def reload(self):
         self.set = dataIO.load_json('data/inviteutils/settings.json')
+        self.migrate()
+
+    def migrate(self):
+        # the invite database used to be keyed by URL, with the uses sometimes stored as strings
+        changed = False
+        for settings in self.set.values():
+            invites = settings.get("invites")
+            if not invites or all('/' not in key and type(data["uses"]) is int for key, data in invites.items()):
+                continue
+            settings["invites"] = {}
+            for key, data in invites.items():
+                data["uses"] = int(data["uses"])
+                settings["invites"][invite_code(key)] = data
+            changed = True
+        if changed:
+            self.save()
+
+    def template(self, text, arguments):
+        """The compiled template of a message, raises ValueError if it isn't a valid one."""
+        template = self.templates.get((text, len(arguments)))
+        if template is None:
+            template = self.templates[(text, len(arguments))] = MessageTemplate(text, arguments)
+        return template
 
     def server_init(self, server):
         self.set[server.id] = {
@@ -39,27 +200,60 @@ class InviteUtils:
 
     async def on_load_tasks(self):
         await self.bot.wait_until_ready()
-        for server in self.bot.servers:
-            await self.inv_update(server)
+        semaphore = asyncio.Semaphore(self.sync_concurrency)
+        servers = [server for server in self.bot.servers if server.id in self.set]
+        try:
+            # announcing held back joins can fail on a single server, that mustn't lose the others' invite counts
+            results = await asyncio.gather(*[self.startup_sync(server, semaphore) for server in servers], return_exceptions=True)
+            for server, result in zip(servers, results):
+                if isinstance(result, Exception):
+                    print("InviteUtils: failed to sync the invites of {}: {}".format(server.id, result))
+        finally:
+            self.unsynced.clear()   # servers the bot isn't in anymore
+            self.save()
 
-    async def inv_update(self, server):
+    async def startup_sync(self, server, semaphore):
+        async with semaphore:
+            try:
+                invites = await self.bot.invites_from(server)
+            except:
+                invites = None
+        # the invite counts are from before the restart until now, attribute the joins we held back against them
+        members = self.pending_joins.pop(server.id, [])
+        self.unsynced.discard(server.id)
         if server.id not in self.set:
             return
+        if members:
+            await self.process_joins(server, members, invites, save=False)
+        elif invites is not None:
+            self.inv_sync(server, invites, save=False)
+
+    async def inv_update(self, server):
+        if server.id not in self.set or self.attributing(server):
+            return  # the joins being attributed will sync the invites
         try:
             invites = await self.bot.invites_from(server)
         except:
             return
-        invite_urls = []
+        self.inv_sync(server, invites)
+
+    def attributing(self, server):
+        """Whether joins are waiting to be attributed against the stored invite uses."""
+        return server.id in self.join_windows or server.id in self.closing_windows or server.id in self.unsynced
+
+    def inv_sync(self, server, invites, save=True):
+        stored = self.set[server.id]["invites"]
+        codes = set()
         for inv in invites:
-            if inv.url not in self.set[server.id]["invites"]:
-                self.set[server.id]["invites"][inv.url] = {"uses": inv.uses}
+            if inv.code not in stored:
+                stored[inv.code] = {"uses": inv.uses}
             else:
-                self.set[server.id]["invites"][inv.url]["uses"] = inv.uses    # sync uses
-            invite_urls.append(inv.url)
-        for inv_url in list(self.set[server.id]["invites"]):
-            if inv_url not in invite_urls:
-                del self.set[server.id]["invites"][inv_url]                   # clean up database
-        self.save()
+                stored[inv.code]["uses"] = inv.uses     # sync uses
+            codes.add(inv.code)
+        for code in [code for code in stored if code not in codes]:
+            del stored[code]                            # clean up database
+        if save:
+            self.save()
 
     async def confirm_msg(self, ctx,  e: discord.Embed, timeout: int):
         server = ctx.message.server
@@ -119,8 +313,8 @@ Example formats:
     {3.name}    - the name of the role being assigned on join.
 Message Examples:
     join:
-        Hey {0.mention}, welcome to {2.name}! You have been assigned to {3.name}. I hope you enjoy your stay!
-        User {0.mention} joined with {1.url}, referred by {1.inviter}. Welcome to {2.name}!
+        Hey {0.mention}, welcome to {1.name}! You have been assigned to {3.name}. I hope you enjoy your stay!
+        User {0.mention} joined with {2.url}, referred by {2.inviter}. Welcome to {1.name}!
     leave:
         {0.name} has just left {1.name}! Bye {0.name}, hope you had a good stay!"""
         await self.bot.say("**Here are some examples!**\n\n" + "```css\n" + msg + "```")
@@ -175,6 +369,11 @@ Message Examples:
         server = ctx.message.server
         if server.id not in self.set:
             self.server_init(server)
+        try:
+            self.template(message, JOIN_ARGUMENTS)
+        except ValueError as e:
+            await self.bot.say("That join message can't be used: {}".format(e))
+            return
         self.set[server.id]['joinmessage'] = message
         await self.bot.say("Join message has been set.")
         self.save()
@@ -185,6 +384,11 @@ Message Examples:
         server = ctx.message.server
         if server.id not in self.set:
             self.server_init(server)
+        try:
+            self.template(message, LEAVE_ARGUMENTS)
+        except ValueError as e:
+            await self.bot.say("That leave message can't be used: {}".format(e))
+            return
         self.set[server.id]['leavemessage'] = message
         await self.bot.say("Leave message has been set.")
         self.save()
@@ -281,28 +485,31 @@ Message Examples:
         except:
             await self.bot.say("There is no invites on this server.")
             return
-        if invite.startswith("https://discord.gg/") or invite.startswith("http://discord.gg/"):
-            tmp = invite.split('/')
-            invite = tmp[3]
-        await self.inv_update(server)   # make sure we're working on updated database
-        for inv in invites:
-            tmp = inv.url.split('/')
-            if tmp[3] == invite and inv.url in self.set[server.id]["invites"]:
-                if "role" in self.set[server.id]["invites"][inv.url]:
-                    prev_role = discord.utils.get(server.roles, id=self.set[server.id]["invites"][inv.url]["role"])
-                    if prev_role is not None:
-                        e = discord.Embed(description="This invite already has a role assigned to it. Replace?")
-                        e.add_field(name="Invite", value=inv.url, inline=False)
-                        e.add_field(name="Current Role", value=prev_role.name, inline=True)
-                        e.add_field(name="Replacing Role", value=role.name, inline=True)
-                        confirm = await self.confirm_msg(ctx, e, 60)
-                        if confirm is False:
-                            return
-                self.set[server.id]["invites"][inv.url]["role"] = role.id
-                await self.bot.say("The `{}` role is now bound to the `{}` invite.".format(role.name, invite))
-                self.save()
-                return
-        await self.bot.say("That invite doesn't seem to exist.")
+        invite = invite_code(invite)
+        if self.attributing(server):
+            # syncing the uses now would hide the waiting joins from the deltas, only add the
+            # invites we don't know yet, counting from zero like invite_deltas does
+            for inv in invites:
+                self.set[server.id]["invites"].setdefault(inv.code, {"uses": 0})
+        else:
+            self.inv_sync(server, invites)  # make sure we're working on updated database
+        data = self.set[server.id]["invites"].get(invite)
+        if data is None:
+            await self.bot.say("That invite doesn't seem to exist.")
+            return
+        if "role" in data:
+            prev_role = discord.utils.get(server.roles, id=data["role"])
+            if prev_role is not None:
+                e = discord.Embed(description="This invite already has a role assigned to it. Replace?")
+                e.add_field(name="Invite", value="http://discord.gg/" + invite, inline=False)
+                e.add_field(name="Current Role", value=prev_role.name, inline=True)
+                e.add_field(name="Replacing Role", value=role.name, inline=True)
+                confirm = await self.confirm_msg(ctx, e, 60)
+                if confirm is False:
+                    return
+        data["role"] = role.id
+        await self.bot.say("The `{}` role is now bound to the `{}` invite.".format(role.name, invite))
+        self.save()
 
     @invutils.command(pass_context=True)
     async def removerole(self, ctx, invite: str):
@@ -310,11 +517,7 @@ Message Examples:
         server = ctx.message.server
         if server.id not in self.set:
             self.server_init(server)
-        if invite.startswith("https://discord.gg/") or invite.startswith("http://discord.gg/"):
-            tmp = invite.split('/')
-            invite = "http://discord.gg/" + tmp[3]
-        else:
-            invite = "http://discord.gg/" + invite
+        invite = invite_code(invite)
         if invite not in self.set[server.id]["invites"] or "role" not in self.set[server.id]["invites"][invite]:
             await self.bot.say("That invite doesn't seem to have any roles assigned to it.")
             return
@@ -322,7 +525,7 @@ Message Examples:
         if role is None:
             role = discord.Role(name="deleted-role", id=0, position=0, server=server)
         e = discord.Embed(description="You are about to delete a role-invite link:")
-        e.add_field(name="Invite", value=invite, inline=False)
+        e.add_field(name="Invite", value="http://discord.gg/" + invite, inline=False)
         e.add_field(name="Role", value=role.name, inline=False)
         confirm = await self.confirm_msg(ctx, e, 60)
         if confirm is True:
@@ -345,15 +548,24 @@ Message Examples:
                 role = discord.utils.get(server.roles, id=self.set[server.id]["invites"][inv]["role"])
                 if role is None:
                     role = discord.Role(name="deleted-role", id=0, position=0, server=server)
-                tmp = inv.split('/')
-                n = max(8 - len(tmp[3]), 0)
+                n = max(8 - len(inv), 0)
                 spaces = ' ' * n
-                msg = msg + "{}{} : {}".format(tmp[3], spaces, role.name) + "\n"
+                msg = msg + "{}{} : {}".format(inv, spaces, role.name) + "\n"
         if msg != "":
             await self.bot.say("List of invites with roles attached to them:\n```\nInvite   : Role\n" + msg + "```")
         else:
             await self.bot.say("There's no invites with roles bound to them on this server!")
 
+    @invutils.command(pass_context=True)
+    async def metrics(self, ctx):
+        """Shows how long joins take to get through."""
+        joins = self.window_timings.count
+        msg = "Joins: {} in {} windows, {} ({:.0%}) with an undetermined invite".format(joins, self.windows, self.undetermined, self.undetermined / joins if joins else 0)
+        for name, timings in (("Join to role", self.join_timings), ("Window", self.window_timings), ("Invite snapshot", self.snapshot_timings), ("Role call", self.role_timings)):
+            msg += "\n{}: p50 {:.0f}ms p99 {:.0f}ms".format(name, timings.percentile(50) * 1000, timings.percentile(99) * 1000)
+        msg += "\nRetries: {} invite snapshots, {} role calls".format(self.snapshot_retries, self.role_retries)
+        await self.bot.say("```\n" + msg + "\n```")
+
     @invutils.command(pass_context=True)
     async def disable(self, ctx):
         """Deletes all settings for the current server."""
@@ -374,70 +586,203 @@ Message Examples:
         server = member.server
         if server.id not in self.set:
             return
-        channel = self.set[server.id]["channel"]
-        joinmessage = self.set[server.id]["joinmessage"]
-        json_list = self.set[server.id]["invites"]
-        if json_list is None:
+        if self.set[server.id]["invites"] is None:
+            return
+        if member.bot:
+            # bots are authorized through OAuth2, they never use an invite
+            role = discord.Role(name="None", id=0, position=0, server=server)
+            if self.set[server.id]["botrole"] is not None:
+                role = discord.utils.get(server.roles, id=self.set[server.id]["botrole"])
+                if role is not None:
+                    await self.assign_role(member, time.monotonic(), role)
+            await self.announce_join(member, None, role)
+            await self.announce_undetermined(server)
             return
+        if server.id in self.unsynced:
+            self.pending_joins.setdefault(server.id, []).append((member, time.monotonic()))
+            return
+        window = self.join_windows.get(server.id)
+        if window is None:
+            window = self.join_windows[server.id] = []
+            self.bot.loop.create_task(self.close_window(server))
+        window.append((member, time.monotonic()))
+
+    async def close_window(self, server):
+        """Attributes every member that joined during the window from a single invite snapshot."""
+        window = self.join_windows[server.id]
+        opened = window[0][1]
+        while True:
+            # close once joins go quiet, or at the latest when the window is full
+            now = time.monotonic()
+            wait = min(window[-1][1] + self.join_quiet, opened + self.join_window) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        # joins from now on open the next window, they'd merge bursts from different invites into this one
+        members = self.join_windows.pop(server.id)
+        closing = self.closing_windows.setdefault(server.id, [])
+        closing.append(members)
         try:
-            invites = await self.bot.invites_from(server)
-        except:
-            await self.bot.say("There is no invites on this server.")
+            lock = self.snapshot_locks.setdefault(server.id, asyncio.Lock())
+            async with lock:    # the deltas have to start from the previous window's snapshot
+                invites, later = await self.take_snapshot(server, members)
+                invite, role = self.settle_joins(server, members, invites, later=later)
+        finally:
+            closing.remove(members)
+            if not closing:
+                del self.closing_windows[server.id]
+        await self.welcome_joins(server, members, invite, role)
+
+    def later_joins(self, server, members):
+        """How many members joined after the window of `members` closed."""
+        closing = self.closing_windows.get(server.id, [])
+        position = next(i for i, window in enumerate(closing) if window is members)
+        return sum(len(window) for window in closing[position + 1:]) + len(self.join_windows.get(server.id, []))
+
+    async def take_snapshot(self, server, members):
+        """Fetches the invite list once the uses of the `members` show up in it, or gives up after 3 tries.
+
+        Returns the invites and how many members joined after the window by the time they were fetched."""
+        for attempt in range(3):
+            started = time.monotonic()
+            try:
+                invites = await self.bot.invites_from(server)
+            except:
+                invites = None
+            self.snapshot_timings.add(time.monotonic() - started)
+            later = self.later_joins(server, members)
+            if invites is None or server.id not in self.set:
+                return invites, later
+            missing = self.attribute(server, [member for member, joined in members], invites, later)[2]
+            codes = set(inv.code for inv in invites)
+            if missing <= 0 or attempt == 2 or any(code not in codes for code in self.set[server.id]["invites"]):
+                return invites, later   # an invite that ran out of uses explains the missing ones, looking again won't help
+            # the invite uses can lag behind the join events, look again instead of waiting up front
+            self.snapshot_retries += 1
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def process_joins(self, server, members, invites, save=True):
+        """Attributes, gives roles to and announces members that joined before the `invites` snapshot."""
+        invite, role = self.settle_joins(server, members, invites, save)
+        await self.welcome_joins(server, members, invite, role)
+
+    def settle_joins(self, server, members, invites, save=True, later=0):
+        """Attributes the members that joined before the `invites` snapshot and syncs it.
+
+        `later` members joined after them, before the snapshot was taken. Their uses are left
+        for their own window. Returns the invite the members joined with and the role to give
+        them, when they can be told."""
+        self.windows += 1
+        now = time.monotonic()
+        for member, joined in members:
+            self.window_timings.add(now - joined)
+        invite, role = None, None
+        if server.id in self.set and invites is not None:
+            invite, role, missing = self.attribute(server, [member for member, joined in members], invites, later)
+            if not later:
+                self.inv_sync(server, invites, save)
+            elif invite is not None:
+                # only these members' uses, the later window still has to find its own
+                self.set[server.id]["invites"].setdefault(invite.code, {"uses": 0})["uses"] += len(members)
+                if save:
+                    self.save()
+        if invite is None:
+            self.undetermined += len(members)
+        return invite, role
+
+    async def welcome_joins(self, server, members, invite, role):
+        """Gives the role to and announces the members of a window."""
+        if server.id not in self.set:
             return
-        role = discord.Role(name="None", id=0, position=0, server=server)
-        if member.bot and self.set[server.id]["botrole"] is not None:
-            role = discord.utils.get(server.roles, id=self.set[server.id]["botrole"])
-            if role is not None:
-                await asyncio.sleep(3)
+        if role is not None:
+            await asyncio.gather(*[self.assign_role(member, joined, role) for member, joined in members])
+        for member, joined in members:
+            await self.announce_join(member, invite, role)
+        if invite is None:
+            await self.announce_undetermined(server)
+
+    async def assign_role(self, member, joined, role):
+        """Adds a role to a member that just joined, retrying if Discord isn't ready for it yet."""
+        started = time.monotonic()
+        for attempt in range(5):
+            try:
                 await self.bot.add_roles(member, role)
-        await asyncio.sleep(1)
-        invite = None
-        determined = False
-        for inv in invites:
-            if inv.url in json_list and int(inv.uses) == int(json_list[inv.url]["uses"])+1:
-                if "role" in json_list[inv.url]:
-                    role = discord.utils.get(server.roles, id=json_list[inv.url]["role"])
-                    if role is not None:
-                        await asyncio.sleep(3)
-                        await self.bot.add_roles(member, role)
-                if invite is None:
-                    invite = inv    #found it!
-                    determined = True
-                else:
-                    determined = False
-            elif inv.url not in json_list and int(inv.uses) == 1:      #looks like we don't have that invite in the database yet but somebody just used it
-                if invite is None:
-                    invite = inv    #found it!
-                    determined = True
-                else:
-                    determined = False
+                break
+            except discord.Forbidden:
+                return
+            except discord.HTTPException as e:
+                status = getattr(e.response, "status", 0)
+                if status not in (404, 429) and status < 500:
+                    return
+                delay = 0.25 * 2 ** attempt
+                if status == 429:
+                    try:
+                        delay = float(e.response.headers.get("Retry-After"))
+                    except (AttributeError, TypeError, ValueError):
+                        pass
+                self.role_retries += 1
+                await asyncio.sleep(delay)
+        else:
+            return
+        now = time.monotonic()
+        self.role_timings.add(now - started)
+        self.join_timings.add(now - joined)
+
+    def attribute(self, server, members, invites, later=0):
+        """Matches the invite use deltas since the last snapshot to the members that joined.
+
+        The uses of the `later` members that joined after them can be in the snapshot too, so
+        it has to account for all of them. Returns the invite (if all of them used the same one),
+        the role to give (if every invite they could have used gives the same role) and how
+        many uses are missing."""
+        stored = self.set[server.id]["invites"]
+        used = [(inv, delta) for inv, delta in invite_deltas(stored, invites) if delta > 0]
+        missing = len(members) + later - sum(delta for inv, delta in used)
+        if not used or missing != 0:
+            return None, None, missing  # uses we can't see, an invite probably ran out of uses
+        used = [inv for inv, delta in used]
+        role_ids = set(stored.get(inv.code, {}).get("role") for inv in used)
+        role = None
+        if len(role_ids) == 1 and None not in role_ids:
+            role = discord.utils.get(server.roles, id=role_ids.pop())
+        return (used[0] if len(used) == 1 else None), role, 0
+
+    async def announce_join(self, member, invite, role):
+        server = member.server
+        channel = self.set[server.id]["channel"]
+        joinmessage = self.set[server.id]["joinmessage"]
+        if role is None:
+            role = discord.Role(name="None", id=0, position=0, server=server)
         if self.set[server.id]["join"] is True and channel is not None and joinmessage is not None:
-            if invite is None or determined is False: #couldn't determine the correct invite, switching to default
+            if invite is None: #couldn't determine the correct invite, switching to default
                 invite = discord.Invite(server=server, url="Unknown", inviter={"name": "Unknown", "discriminator": "0000", "id": 0}, code="Unknown", uses="Unknown", max_uses="Unknown")
+            try:
+                text = self.template(joinmessage, JOIN_ARGUMENTS).render(member, server, invite, role)
+            except Exception as e:
+                await self.bot.send_message(server.get_channel(channel), "Your `joinmessage` was improperly formatted!:\n{}".format(e))
+                return
             if self.set[server.id]["embed"]:
                 try:
-                    e = discord.Embed(title="Member Joined!", description=joinmessage.format(member, server, invite, role), color=self.joinmessage_color)
+                    e = discord.Embed(description=text, **self.join_embed)
                     e.set_thumbnail(url=member.avatar_url)
                     await self.bot.send_message(server.get_channel(channel), embed=e)
                 except discord.Forbidden:
                     await self.bot.send_message(server.get_channel(channel), "Was unable to embed a message. Need EMBED_LINKS permissions.")
-                    await self.bot.send_message(server.get_channel(channel), joinmessage.format(member, server, invite, role))
-                except Exception as e:
-                    await self.bot.send_message(server.get_channel(channel), "Your `joinmessage` was improperly formatted!:\n{}".format(e))
+                    await self.bot.send_message(server.get_channel(channel), text)
             else:
-                try:
-                    await self.bot.send_message(server.get_channel(channel), joinmessage.format(member, server, invite, role))
-                except Exception as e:
-                    await self.bot.send_message(server.get_channel(channel), "Your `joinmessage` was improperly formatted!:\n{}".format(e))
-            if determined is False:
-                await self.bot.send_message(server.get_channel(channel), """The correct invite the last user joined with couldn't be determined, possible causes are:
+                await self.bot.send_message(server.get_channel(channel), text)
+
+    async def announce_undetermined(self, server):
+        channel = self.set[server.id]["channel"]
+        if self.set[server.id]["join"] is True and channel is not None and self.set[server.id]["joinmessage"] is not None:
+            await self.bot.send_message(server.get_channel(channel), """The correct invite the last user(s) joined with couldn't be determined, possible causes are:
 ```
 1. The user joined with an invite that had limited uses and it just ran out of uses.
 2. The user that joined was a bot authorized by the OAuth2 system instead of the standard invite.
 3. The database wasn't synced properly - probably because the bot wasn't online when the last user joined.
+4. Several users joined at once, using different invites.
 Tip: Checking settings for the current server syncs the database. (info)
 ```""")
-        await self.inv_update(server)
 
     async def on_member_remove(self, member):
         server = member.server
@@ -447,19 +792,23 @@ Tip: Checking settings for the current server syncs the database. (info)
         leavemessage = self.set[server.id]["leavemessage"]
         if channel is None or leavemessage is None:
             return
-        if self.set[server.id]["embed"]:
+        try:
+            text = self.template(leavemessage, LEAVE_ARGUMENTS).render(member, server)
+        except Exception as e:
+            await self.bot.send_message(server.get_channel(channel), "Your `leavemessage` was improperly formatted!:\n{}".format(e))
+            text = None
+        if text is None:
+            pass
+        elif self.set[server.id]["embed"]:
             try:
-                e = discord.Embed(title="Member Left!", description=leavemessage.format(member, server), color=self.leavemessage_color)
+                e = discord.Embed(description=text, **self.leave_embed)
                 e.set_thumbnail(url=member.avatar_url)
                 await self.bot.send_message(server.get_channel(channel), embed=e)
             except discord.Forbidden:
-                await self.bot.say("Was unable to embed a message. Need EMBED_LINKS permissions.")
-                await self.bot.send_message(server.get_channel(channel), leavemessage.format(member, server))
-            except:
-                await self.bot.say("Your `leavemessage` was improperly formatted!")
+                await self.bot.send_message(server.get_channel(channel), "Was unable to embed a message. Need EMBED_LINKS permissions.")
+                await self.bot.send_message(server.get_channel(channel), text)
         else:
-            await self.bot.send_message(server.get_channel(channel), leavemessage.format(member, server))
-        await self.inv_update(server)
+            await self.bot.send_message(server.get_channel(channel), text)
 
 def check_folder():
     if not os.path.exists('data/inviteutils'):